@@ -4,7 +4,7 @@ import time
 import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox
-from utils import serialize_object, deserialize_object, split_image_into_4, concatenate_4_images
+from utils import serialize_object, deserialize_object, split_image_into_4, concatenate_4_images, lookup_servers
 
 def test_connection(ip, port):
     try:
@@ -32,6 +32,15 @@ class ClientApp:
             port_entry.pack(side=tk.LEFT)
             self.entries.append((ip_entry, port_entry))
 
+        registry_frame = tk.Frame(root)
+        registry_frame.pack()
+        tk.Label(registry_frame, text="Registry").pack(side=tk.LEFT)
+        self.registry_ip = tk.Entry(registry_frame, width=15)
+        self.registry_ip.pack(side=tk.LEFT)
+        self.registry_port = tk.Entry(registry_frame, width=5)
+        self.registry_port.pack(side=tk.LEFT)
+        tk.Button(root, text="Find Servers", command=self.find_servers).pack(pady=5)
+
         self.status_labels = []
         for i in range(4):
             lbl = tk.Label(root, text=f"Server {i+1} Status: Not checked")
@@ -44,6 +53,22 @@ class ClientApp:
         self.log_area = tk.Text(root, height=10, width=50)
         self.log_area.pack(pady=10)
 
+    def find_servers(self):
+        # Fill the server boxes with the least loaded live servers from the registry
+        try:
+            servers = lookup_servers((self.registry_ip.get(), int(self.registry_port.get())), len(self.entries))
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Registry", f"Registry lookup failed: {e}")
+            return
+        if len(servers) < len(self.entries):
+            messagebox.showwarning("Registry", f"Only {len(servers)} live servers registered")
+        for (ip_entry, port_entry), (ip, port) in zip(self.entries, servers):
+            ip_entry.delete(0, tk.END)
+            ip_entry.insert(0, ip)
+            port_entry.delete(0, tk.END)
+            port_entry.insert(0, str(port))
+        self.log_area.insert(tk.END, f"Found {len(servers)} live servers\n")
+
     def check_connections(self):
         for i, (ip_entry, port_entry) in enumerate(self.entries):
             ip = ip_entry.get()
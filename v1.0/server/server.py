@@ -4,7 +4,13 @@ import threading
 import time
 import tkinter as tk
 from tkinter import messagebox
-from utils import deserialize_object, serialize_object, process_image
+import os
+from utils import deserialize_object, serialize_object, process_image, start_heartbeat
+
+# Load reported to the registry: parts being processed and a moving average
+# of processing speed in pixels per second
+load = {"in_flight": 0, "pixels_per_second": 0.0}
+load_lock = threading.Lock()
 
 def get_local_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -30,9 +36,19 @@ def handle_client(conn, addr, port, log_area):
     cv2.imshow(f"Received Part [Port {port}]", image_part)
     cv2.waitKey(500)
 
+    with load_lock:
+        load["in_flight"] += 1
     start_time = time.time()
-    processed = process_image(image_part)
-    proc_time = time.time() - start_time
+    try:
+        processed = process_image(image_part)
+    finally:
+        proc_time = time.time() - start_time
+        with load_lock:
+            load["in_flight"] -= 1
+            pixels = image_part.shape[0] * image_part.shape[1]
+            if proc_time > 0:
+                rate = pixels / proc_time
+                load["pixels_per_second"] = rate if not load["pixels_per_second"] else 0.7 * load["pixels_per_second"] + 0.3 * rate
 
     cv2.imshow(f"Processed Image [Port {port}]", processed)
     cv2.waitKey(500)
@@ -66,12 +82,28 @@ def launch_server():
     port_entry = tk.Entry(frame)
     port_entry.pack()
 
+    tk.Label(frame, text="Registry IP:Port (optional):").pack()
+    registry_entry = tk.Entry(frame)
+    registry_entry.pack()
+
     log_area = tk.Text(root, height=15, width=50)
     log_area.pack(pady=10)
 
+    def report(port):
+        with load_lock:
+            return {"node": f"{socket.gethostname()}/{os.getpid()}/{port}", "address": [ip, port], "workers": 1,
+                    "queued": 0, "in_flight": load["in_flight"], "pending_pixels": 0,
+                    "pixels_per_second": load["pixels_per_second"]}
+
     def run_server():
         port = int(port_entry.get())
         threading.Thread(target=start_server, args=(port, log_area)).start()
+        registry = registry_entry.get().strip()
+        if registry:
+            # Let clients find this server through the registry
+            registry_ip, _, registry_port = registry.rpartition(":")
+            start_heartbeat((registry_ip, int(registry_port)), lambda: report(port))
+            log_area.insert(tk.END, f"Sending heartbeats to {registry}\n")
 
     tk.Button(frame, text="Start Server", command=run_server).pack()
     root.mainloop()
@@ -1,6 +1,11 @@
 import cv2
 import numpy as np
 import pickle
+import json
+import time
+import socket
+import struct
+import threading
 
 def serialize_object(obj):
     return pickle.dumps(obj)
@@ -14,16 +19,63 @@ def process_image(image):
     processed = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
     return processed
 
+def split_image_grid(image, rows, cols):
+    # Split into rows x cols near-equal parts, row by row
+    h, w = image.shape[:2]
+    ys = [h * i // rows for i in range(rows + 1)]
+    xs = [w * j // cols for j in range(cols + 1)]
+    return [image[ys[i]:ys[i + 1], xs[j]:xs[j + 1]] for i in range(rows) for j in range(cols)]
+
+def concatenate_grid(parts, rows, cols):
+    return np.vstack([np.hstack(parts[i * cols:(i + 1) * cols]) for i in range(rows)])
+
 def split_image_into_4(image):
-    h, w, _ = image.shape
-    return [
-        image[0:h//2, 0:w//2],
-        image[0:h//2, w//2:],
-        image[h//2:, 0:w//2],
-        image[h//2:, w//2:]
-    ]
+    return split_image_grid(image, 2, 2)
 
 def concatenate_4_images(parts):
-    top = np.hstack((parts[0], parts[1]))
-    bottom = np.hstack((parts[2], parts[3]))
-    return np.vstack((top, bottom))
+    return concatenate_grid(parts, 2, 2)
+
+# Registry messages use the v2.0 framing: kind, request id and payload
+# length, then a JSON payload
+REGISTRY_FRAME = struct.Struct("!BQQ")
+HEARTBEAT = 6
+LOOKUP = 7
+
+def send_registry_message(sock, kind, message):
+    payload = json.dumps(message).encode("utf-8")
+    sock.sendall(REGISTRY_FRAME.pack(kind, 0, len(payload)) + payload)
+
+def recv_all(sock, size):
+    data = b''
+    while len(data) < size:
+        packet = sock.recv(size - len(data))
+        if not packet:
+            raise ConnectionError("Registry closed the connection")
+        data += packet
+    return data
+
+def lookup_servers(registry, count=None):
+    # Live servers known to the registry, least loaded first, as (ip, port)
+    with socket.create_connection(registry, timeout=5) as s:
+        send_registry_message(s, LOOKUP, {"count": count})
+        _, _, size = REGISTRY_FRAME.unpack(recv_all(s, REGISTRY_FRAME.size))
+        servers = json.loads(recv_all(s, size).decode("utf-8"))["servers"]
+    return [tuple(server["address"]) for server in servers]
+
+def start_heartbeat(registry, report, interval=1.0):
+    # Send report() to the registry every `interval` seconds on a background
+    # thread, reconnecting if the registry goes away
+    def run():
+        s = None
+        while True:
+            try:
+                if s is None:
+                    s = socket.create_connection(registry, timeout=5)
+                send_registry_message(s, HEARTBEAT, report())
+            except OSError:
+                if s is not None:
+                    s.close()
+                s = None
+            time.sleep(interval)
+
+    threading.Thread(target=run, daemon=True).start()
@@ -0,0 +1,164 @@
+import cv2
+import numpy as np
+from functools import lru_cache
+
+# Kernels are built once here instead of on every call to process_image
+SHARPEN_KERNEL = np.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])
+MORPH_KERNEL = np.ones((5, 5), np.uint8)
+
+# Every output the pipeline can produce, in the order the client stores them
+OUTPUT_KEYS = [
+    "gray",
+    "blurred",
+    "edges",
+    "thresholded",
+    "equalized",
+    "resized",
+    "contrast_adjusted",
+    "brightness_adjusted",
+    "sharpened",
+    "hsv",
+    "lab",
+    "eroded",
+    "dilated",
+    "opened",
+    "closed",
+    "median_blurred",
+    "bilateral_filtered",
+    "corners"
+]
+
+# Registry of ops: name -> (input names, function). "image" is the source tile.
+OPS = {}
+
+def op(name, *inputs):
+    # Register a function as the op that produces `name` from `inputs`
+    def register(fn):
+        OPS[name] = (inputs, fn)
+        return fn
+    return register
+
+@op("gray", "image")
+def gray_op(image):
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+@op("blurred", "gray")
+def blurred_op(gray):
+    return cv2.GaussianBlur(gray, (5, 5), 0)
+
+@op("edges", "blurred")
+def edges_op(blurred):
+    return cv2.Canny(blurred, 100, 200)
+
+@op("thresholded", "gray")
+def thresholded_op(gray):
+    _, thresholded = cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY)
+    return thresholded
+
+@op("equalized", "gray")
+def equalized_op(gray):
+    return cv2.equalizeHist(gray)
+
+@op("resized", "gray")
+def resized_op(gray):
+    return cv2.resize(gray, (128, 128))
+
+@op("contrast_adjusted", "gray")
+def contrast_adjusted_op(gray):
+    return cv2.convertScaleAbs(gray, alpha=1.5, beta=0)
+
+@op("brightness_adjusted", "gray")
+def brightness_adjusted_op(gray):
+    return cv2.convertScaleAbs(gray, alpha=1.0, beta=50)
+
+@op("sharpened", "gray")
+def sharpened_op(gray):
+    return cv2.filter2D(gray, -1, SHARPEN_KERNEL)
+
+@op("hsv", "image")
+def hsv_op(image):
+    return cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+
+@op("lab", "image")
+def lab_op(image):
+    return cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
+
+@op("eroded", "gray")
+def eroded_op(gray):
+    return cv2.erode(gray, MORPH_KERNEL, iterations=1)
+
+@op("dilated", "gray")
+def dilated_op(gray):
+    return cv2.dilate(gray, MORPH_KERNEL, iterations=1)
+
+# Opening is dilate(erode(x)) and closing is erode(dilate(x)), so reuse the
+# eroded/dilated intermediates instead of running morphologyEx from scratch
+@op("opened", "eroded")
+def opened_op(eroded):
+    return cv2.dilate(eroded, MORPH_KERNEL, iterations=1)
+
+@op("closed", "dilated")
+def closed_op(dilated):
+    return cv2.erode(dilated, MORPH_KERNEL, iterations=1)
+
+@op("median_blurred", "gray")
+def median_blurred_op(gray):
+    return cv2.medianBlur(gray, 5)
+
+@op("bilateral_filtered", "gray")
+def bilateral_filtered_op(gray):
+    return cv2.bilateralFilter(gray, 9, 75, 75)
+
+@op("harris", "gray")
+def harris_op(gray):
+    return cv2.cornerHarris(gray, 2, 3, 0.04)
+
+@op("corners", "image", "harris")
+def corners_op(image, harris):
+    corner_image = np.copy(image)
+    corner_image[harris > 0.01 * harris.max()] = [0, 0, 255]  # Mark corners in red
+    return corner_image
+
+@lru_cache(maxsize=None)
+def build_plan(outputs):
+    # Order the ops needed for `outputs` so every input is computed before use
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name == "image" or name in order:
+            return
+        if name not in OPS:
+            raise KeyError(f"Unknown pipeline output: {name}")
+        if name in visiting:
+            raise ValueError(f"Cycle in pipeline at {name}")
+        visiting.add(name)
+        for dep in OPS[name][0]:
+            visit(dep)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in outputs:
+        visit(name)
+
+    # Record after which step each intermediate can be dropped
+    last_use = {}
+    for step, name in enumerate(order):
+        for dep in OPS[name][0]:
+            last_use[dep] = step
+    releases = [[] for _ in order]
+    for name, step in last_use.items():
+        if name != "image" and name not in outputs:
+            releases[step].append(name)
+
+    return tuple((name, OPS[name][0], OPS[name][1], tuple(releases[step])) for step, name in enumerate(order))
+
+def process_image(image, outputs=None):
+    # Run only the ops needed for the requested outputs (all of them by default)
+    outputs = tuple(OUTPUT_KEYS if outputs is None else outputs)
+    values = {"image": image}
+    for name, inputs, fn, releases in build_plan(outputs):
+        values[name] = fn(*(values[dep] for dep in inputs))
+        for dep in releases:
+            del values[dep]
+    return {name: values[name] for name in outputs}
@@ -0,0 +1,136 @@
+import cv2
+import numpy as np
+import socket
+import time
+import os
+import pickle
+import signal
+import argparse
+import multiprocessing as mp
+from pipeline import process_image
+
+def send_image_data(conn, image_data):
+    # Serialize the image data
+    data = pickle.dumps(image_data)
+    # Send the size of the data first
+    conn.sendall(len(data).to_bytes(8, byteorder='big'))
+    # Send the actual data
+    conn.sendall(data)
+
+def start_server(host, port, output_dir, reuse_port=False):
+    # Create the output directory if it doesn't exist
+    os.makedirs(output_dir, exist_ok=True)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+        if reuse_port:
+            # Let several listener processes bind the same port
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind((host, port))
+        server_socket.listen()
+        print(f"Server {os.getpid()} listening on {host}:{port}")
+
+        while True:
+            conn, addr = server_socket.accept()
+            with conn:
+                print(f"Connected by {addr}")
+
+                # Receive the size of the image data first
+                size_data = conn.recv(8)
+                size = int.from_bytes(size_data, byteorder='big')  # Fixed line
+                print(f"Expecting {size} bytes of image data")
+
+                # Receive the image data
+                data = b''
+                while len(data) < size:
+                    packet = conn.recv(min(4096, size - len(data)))
+                    if not packet:
+                        break
+                    data += packet
+                    print(f"Received {len(packet)} bytes, total {len(data)} bytes")
+
+                print("Finished receiving data")
+
+                # Deserialize the image
+                image_part = np.frombuffer(data, dtype=np.uint8)
+                image_part = cv2.imdecode(image_part, cv2.IMREAD_COLOR)
+                if image_part is None:
+                    print("Failed to decode image")
+                    continue
+                else:
+                    print("Image decoded successfully")
+                    print(f"Image shape: {image_part.shape}")
+
+                # Convert RGB to BGR if necessary
+                if image_part.shape[2] == 3:  # Check if the image has 3 channels (RGB)
+                    image_part = cv2.cvtColor(image_part, cv2.COLOR_RGB2BGR)
+
+                # Save the received image part. Listener processes share the
+                # port, so files are tagged with this process and the client's
+                # port to keep concurrent requests from overwriting each other.
+                tag = f"{os.getpid()}_{addr[1]}"
+                received_image_path = os.path.join(output_dir, f"received_part_{tag}.png")
+                cv2.imwrite(received_image_path, image_part)
+                print(f"Saved received image part to {received_image_path}")
+
+                # Process the image part
+                start_time = time.time()
+                processed_images = process_image(image_part)
+                processing_time = time.time() - start_time
+
+                # Save the processed images
+                for key, processed_image in processed_images.items():
+                    processed_image_path = os.path.join(output_dir, f"{key}_part_{tag}.png")
+                    cv2.imwrite(processed_image_path, processed_image)
+                    print(f"Saved {key} image part to {processed_image_path}")
+
+                # Send all processed images back to the client
+                send_image_data(conn, processed_images)
+
+                print(f"Processing time on server {port}: {processing_time:.2f} seconds")
+
+def run_listener(host, port, output_dir, reuse_port):
+    try:
+        start_server(host, port, output_dir, reuse_port)
+    except KeyboardInterrupt:
+        pass
+
+def main(argv=None, default_port=65432):
+    # Every option can also be set through a SERVER_* environment variable
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description="Image processing server")
+    parser.add_argument("--host", default=env("SERVER_HOST", "127.0.0.1"), help="address to listen on")
+    parser.add_argument("--port", type=int, default=int(env("SERVER_PORT", default_port)))
+    parser.add_argument("--processes", type=int, default=int(env("SERVER_PROCESSES", 1)),
+                        help="listener processes sharing the port through SO_REUSEPORT")
+    parser.add_argument("--output-dir", default=env("SERVER_OUTPUT_DIR", "server_output"), help="directory to save server images")
+    args = parser.parse_args(argv)
+    if args.processes < 1:
+        parser.error("--processes must be at least 1")
+    if args.processes > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("--processes above 1 needs SO_REUSEPORT, which this platform lacks")
+
+    if args.processes == 1:
+        run_listener(args.host, args.port, args.output_dir, False)
+        return
+
+    # Each process handles its own connections; the kernel spreads them across the listeners
+    context = mp.get_context("spawn")
+    listeners = [context.Process(target=run_listener, args=(args.host, args.port, args.output_dir, True)) for _ in range(args.processes)]
+    for listener in listeners:
+        listener.start()
+    # Stop the listeners cleanly whether this process gets Ctrl-C or SIGTERM
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for listener in listeners:
+            listener.join()
+    except KeyboardInterrupt:
+        for listener in listeners:
+            if listener.is_alive():
+                os.kill(listener.pid, signal.SIGINT)
+        for listener in listeners:
+            listener.join(timeout=10)
+            if listener.is_alive():
+                listener.terminate()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -1,141 +1,490 @@
-from PIL import Image
 import numpy as np
 import cv2
-import socket
+import functools
 import time
-import concurrent.futures
 import os
-import pickle
-import zlib
-
-def split_image(image):
-    # Split the image into 4 parts
-    height, width = image.shape[:2]
-    mid_x, mid_y = width // 2, height // 2
-    parts = [
-        image[:mid_y, :mid_x],  # Top-left
-        image[:mid_y, mid_x:],   # Top-right
-        image[mid_y:, :mid_x],   # Bottom-left
-        image[mid_y:, mid_x:]    # Bottom-right
-    ]
-    return parts
-
-def concatenate_image(parts):
-    # Concatenate the 4 parts into a single image
-    top = np.hstack((parts[0], parts[1]))
-    bottom = np.hstack((parts[2], parts[3]))
-    final_image = np.vstack((top, bottom))
-    return final_image
-
-def receive_image_data(conn):
-    # Receive the size of the data first
-    size_data = conn.recv(8)
-    if not size_data:
-        raise EOFError("Connection closed by server")
-    size = int.from_bytes(size_data, byteorder='big')
-    # Receive the actual data
-    data = b''
-    while len(data) < size:
-        packet = conn.recv(min(4096, size - len(data)))
-        if not packet:
-            raise EOFError("Connection closed by server")
-        data += packet
-    # Decompress and deserialize the data
-    return pickle.loads(zlib.decompress(data))
-
-def send_image_part(host, port, image_part):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-        client_socket.connect((host, port))
-        _, img_encoded = cv2.imencode('.png', image_part)
-        img_data = img_encoded.tobytes()  # Convert to raw bytes
-
-        # Send the size of the image data first
-        size = len(img_data)
-        client_socket.sendall(size.to_bytes(8, byteorder='big'))  # Send size as 8 bytes
-        print(f"Sending {size} bytes to {host}:{port}")
-
-        # Send the image data
-        client_socket.sendall(img_data)
-
-        # Receive all processed images
-        processed_images = receive_image_data(client_socket)
-        return processed_images
-
-def process_part_parallel(server_info, image_part, index):
+import glob
+import argparse
+import tempfile
+import threading
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pipeline import OUTPUT_KEYS, UNALIGNED_OUTPUTS, PARTIAL_OUTPUTS, TWO_PHASE_OUTPUTS, required_halo, level_name, parse_level
+from tiling import tiles_of_size, tile_bounds, tile_core, scale_tile, crop_halo, Canvas
+from reduction import SOURCE_OUTPUTS, tiled_outputs, finish_outputs
+from deepzoom import level_count, complete_levels, write_pyramid
+from scheduler import process_tiles
+from routing import assign, position_key
+from transport import ConnectionPool
+from protocol import encode_arrays, decode_arrays, load_json
+from registry import lookup_servers, parse_address
+from cache import tile_key
+from raster import open_raster
+from timing import StageTimes
+from tracing import Tracer, TracedTimes
+
+def send_image_part(pool, server, image_part, outputs, core, on_output, attempt, times):
+    host, port = server
+    # Encode with whichever codec this server's connection negotiated. The
+    # outputs wanted and the tile's core region (for partial statistics)
+    # travel as small arrays alongside the tile, and so does the trace id if
+    # the image is traced.
+    conn = pool.get(server)
+    request = {
+        "image": image_part,
+        "outputs": np.frombuffer(",".join(outputs).encode("utf-8"), dtype=np.uint8),
+        "core": np.array(core, dtype=np.int64),
+    }
+    trace = times.trace
+    if trace is not None:
+        request["trace"] = np.array([trace.trace_id], dtype=np.uint64)
+    with times.measure("encode"):
+        buffers = encode_arrays(request, conn.codec)
+    print(f"Sending {sum(memoryview(buffer).nbytes for buffer in buffers)} bytes to {host}:{port} ({conn.codec.spec})")
+
+    # Outputs arrive one frame at a time and are handed to on_output as they
+    # come in; the request completes once the server has sent all of them,
+    # unless the scheduler gives up on this attempt first
+    def receive_output(payload):
+        with times.measure("decode"):
+            outputs = decode_arrays(payload)
+        for key, processed_image in outputs.items():
+            on_output(key, processed_image)
+
+    # The round trip covers sending, the server's work and receiving
+    sent_at = time.time()
+    started = time.perf_counter()
+    try:
+        response = attempt.wait(conn.request(*buffers, on_output=receive_output))
+    except TimeoutError:
+        # Whatever held the request up may hold up the rest of the connection,
+        # so later requests get a fresh one; those already on it carry on
+        pool.evict(server, conn)
+        raise
+    round_trip = time.perf_counter() - started
+    times.add("round_trip", round_trip)
+    if trace is not None:
+        trace.record("round_trip", sent_at, round_trip, {"server": f"{host}:{port}"})
+
+    # The server reports its time per stage and per op with the response;
+    # what it doesn't account for after the tile arrived was spent in transit
+    if response:
+        report = load_json(response)
+        for stage, seconds in report["stages"].items():
+            times.add(f"server_{stage}", seconds)
+        for op, seconds in report["ops"].items():
+            times.add(f"op_{op}", seconds)
+        times.add("transfer", max(0.0, round_trip - (report["total"] - report["stages"]["receive"])))
+        if trace is not None and "trace" in report:
+            trace.add_remote(f"server {host}:{port}", report["trace"], sent_at, sent_at + round_trip)
+
+def process_part_parallel(pool, image_job, server_info, job, index, attempt):
     host, port = server_info
-    start_time = time.time()
-    processed_images = send_image_part(host, port, image_part)
-    processing_time = time.time() - start_time
+    times = image_job.times
+    # Tiles are read from the image only when they are sent; one identical to
+    # a tile already sent takes that tile's results instead
+    with times.measure("load"):
+        image_part = image_job.load_tile(job)
+    if image_job.follow(job, image_part):
+        return (index,)
+    start_time = time.perf_counter()
+    send_image_part(pool, server_info, image_part, image_job.outputs, tile_core(image_job.tiles[job]),
+                    functools.partial(image_job.store_output, job), attempt, times)
+    processing_time = time.perf_counter() - start_time
     print(f"Processing time on server {port}: {processing_time:.2f} seconds")
-    return index, processed_images  # Return the index along with the processed images
+    return (index,)
 
-if __name__ == "__main__":
-    # Create the output directory if it doesn't exist
-    OUTPUT_DIR = "client_output"
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-    # Load the TIFF image using Pillow
-    tiff_image = Image.open('santanu.tiff')
-    tiff_image = tiff_image.convert('RGB')  # Convert to RGB if necessary
-    image = np.array(tiff_image)  # Convert to NumPy array for processing
-
-    # Save the original image
-    original_image_path = os.path.join(OUTPUT_DIR, "original_image.png")
-    cv2.imwrite(original_image_path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
-    print(f"Saved original image to {original_image_path}")
-
-    # Split the image into 4 parts
-    parts = split_image(image)
-    for i, part in enumerate(parts):
-        print(f"Part {i} shape: {part.shape}")
-
-    # Define server addresses
-    servers = [
-        ('127.0.0.1', 65432),  # Replace with actual server IPs and ports
-        ('127.0.0.1', 65433),
-        ('127.0.0.1', 65434),
-        ('127.0.0.1', 65435)
-    ]
-
-    # Initialize a dictionary to store processed parts for each type
-    processed_parts = {
-        "gray": [None] * len(parts),
-        "blurred": [None] * len(parts),
-        "edges": [None] * len(parts),
-        "thresholded": [None] * len(parts),
-        "equalized": [None] * len(parts),
-        "resized": [None] * len(parts),
-        "contrast_adjusted": [None] * len(parts),
-        "brightness_adjusted": [None] * len(parts),
-        "sharpened": [None] * len(parts),
-        "hsv": [None] * len(parts),
-        "lab": [None] * len(parts),
-        "eroded": [None] * len(parts),
-        "dilated": [None] * len(parts),
-        "opened": [None] * len(parts),
-        "closed": [None] * len(parts),
-        "median_blurred": [None] * len(parts),
-        "bilateral_filtered": [None] * len(parts),
-        "corners": [None] * len(parts)
-    }
+IMAGE_EXTENSIONS = (".tif", ".tiff", ".png", ".jpg", ".jpeg", ".bmp")
+
+def expand_inputs(inputs):
+    # Image files named by each input: a file, a directory, or a glob pattern
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths.extend(sorted(os.path.join(item, name) for name in os.listdir(item) if name.lower().endswith(IMAGE_EXTENSIONS)))
+        elif glob.has_magic(item):
+            paths.extend(sorted(glob.glob(item)))
+        else:
+            paths.append(item)
+    return paths
+
+def server_levels(tile_size, height, width):
+    # Pyramid levels the servers halve tiles into: down to tiles of about 8
+    # pixels, and no further than 1x1 for the whole image
+    return max(0, min(tile_size.bit_length() - 4, level_count(height, width) - 1))
+
+# Source bands (see ImageJob.read_tile) span up to BAND_TILES tiles of a row,
+# and an image keeps at most MAX_BANDS of them in memory; past that the least
+# recently read one is dropped. Together they bound what the client holds of
+# the source, whatever the image's size.
+BAND_TILES = 8
+MAX_BANDS = 4
+
+class Band:
+    # The region of the source image that some tiles of one row cover, read
+    # once for all of them. Once dropped, its tiles not read yet are read on
+    # their own.
+    def __init__(self, y0, y1):
+        self.lock = threading.Lock()
+        self.bounds = [y0, y1, None, None]
+        self.unread = set()
+        self.array = None
+        self.dropped = False
+
+    def add(self, index, x0, x1):
+        self.unread.add(index)
+        left, right = self.bounds[2:]
+        self.bounds[2:] = [x0 if left is None else min(left, x0), x1 if right is None else max(right, x1)]
+
+class ImageJob:
+    # One image on its way through the client: its tiles, the distinct tiles
+    # actually sent to servers, and the outputs as they arrive. The source is
+    # a raster (raster.open_raster) that tiles are read from as they are
+    # sent, a row of them at a time, so a streamed image never has to be in
+    # memory as a whole. Outputs are placed on one canvas each as they
+    # arrive; with `canvas_dir` the canvases are memory-mapped scratch files
+    # there instead of arrays in RAM. Outputs that depend on the whole image
+    # are finished from the tiles' partial statistics once all of them are
+    # in (reduction.py). Outputs in `pyramid` also get a deep-zoom pyramid,
+    # whose upper levels the servers compute along with the outputs
+    # themselves. Time spent is added to `times`.
+    def __init__(self, path, raster, tile_size, canvas_dir=None, pyramid=(), times=None):
+        self.path = path
+        self.raster = raster
+        self.times = times if times is not None else StageTimes()
+        height, width = raster.shape[:2]
+        # Outputs finished on the client are halved there; the others are
+        # halved tile by tile on the servers, down to `self.levels`
+        self.pyramid = tuple(pyramid)
+        halved = [key for key in self.pyramid if key not in TWO_PHASE_OUTPUTS and key not in UNALIGNED_OUTPUTS]
+        self.levels = server_levels(tile_size, height, width) if halved else 0
+        self.outputs = tiled_outputs(OUTPUT_KEYS) + tuple(level_name(key, level) for key in halved for level in range(1, self.levels + 1))
+        # Split the image into many small tiles, each with a ghost border wide
+        # enough for the pipeline's largest kernel so the stitched result has
+        # no seams, and aligned so that every level halves whole pixel pairs
+        self.tiles = tiles_of_size(height, width, tile_size, tile_size, halo=required_halo(self.outputs), align=2 ** self.levels)
+        # Tiles are read from the raster a row of them at a time (see read_tile)
+        self.bands = {}
+        for index, tile in enumerate(self.tiles):
+            y0, y1, x0, x1 = tile_bounds(tile)
+            self.bands.setdefault((y0, y1, tile.col // BAND_TILES), Band(y0, y1)).add(index, x0, x1)
+        self.live_bands = OrderedDict()
+        self.bands_lock = threading.Lock()
+
+        # Identical tiles (flat backgrounds, borders) are sent once and their
+        # results reused. Tiles are identified by their content hash and their
+        # ghost border, which decides how the results are cropped; the hash is
+        # taken when a tile is read to be sent. The first tile with a hash is
+        # its leader, and outputs stored for it are copied to its followers.
+        self.lock = threading.Lock()
+        self.leaders = {}
+        self.followers = {}
+        self.placed = {}
+
+        # One canvas per output type, filled in place as tiles come back
+        self.scratch = None
+        if canvas_dir is not None:
+            os.makedirs(canvas_dir, exist_ok=True)
+            self.scratch = tempfile.mkdtemp(prefix="canvases_", dir=canvas_dir)
+        # (and per intermediate image a two-phase output is finished from)
+        images = OUTPUT_KEYS + [key for key in self.outputs if key not in OUTPUT_KEYS and key not in PARTIAL_OUTPUTS
+                                and parse_level(key) is None]
+        self.canvases = {key: Canvas(self.tiles, key not in UNALIGNED_OUTPUTS, self.scratch_path(key)) for key in images}
+        # and one per pyramid level computed on the servers
+        self.level_canvases = {}
+        for key in halved:
+            for level in range(1, self.levels + 1):
+                name = level_name(key, level)
+                self.level_canvases[name] = Canvas([scale_tile(tile, level) for tile in self.tiles], True, self.scratch_path(name))
+        # Partial statistics of each tile, for the second phase
+        self.partials = {key: [None] * len(self.tiles) for key in self.outputs if key in PARTIAL_OUTPUTS}
+        print(f"Split {path} into {len(self.tiles)} tiles of up to {tile_size}x{tile_size}")
+
+    def scratch_path(self, name):
+        return os.path.join(self.scratch, f"{name}.npy") if self.scratch is not None else None
+
+    def read_tile(self, index):
+        # Tiles go out in no particular row order, and a strip of the raster
+        # holds pixels of a whole row of tiles, so reading each tile on its
+        # own would decode the same strips again and again. The first tile of
+        # a band (BAND_TILES tiles of a row) reads the region all of them need
+        # instead; it is kept until every tile in it has been read once, or
+        # until MAX_BANDS newer bands are in memory (servers pulling at
+        # different speeds can leave a few tiles of many rows unread). Other
+        # reads (retries, tiles of a dropped band) go to the raster.
+        tile = self.tiles[index]
+        y0, y1, x0, x1 = tile_bounds(tile)
+        key = (y0, y1, tile.col // BAND_TILES)
+        band = self.bands[key]
+        array = None
+        with band.lock:
+            if index in band.unread:
+                band.unread.discard(index)
+                array = band.array
+                if array is None and not band.dropped:
+                    array = band.array = self.raster.read(*band.bounds)
+                self._touch_band(key, band, keep=bool(band.unread))
+        if array is None:
+            return self.raster.read(y0, y1, x0, x1)
+        left = band.bounds[2]
+        return array[:, x0 - left:x1 - left].copy()
+
+    def _touch_band(self, key, band, keep):
+        # Mark a band as just read from, dropping it if none of its tiles are
+        # left, and dropping the least recently read bands past MAX_BANDS
+        with self.bands_lock:
+            if keep and band.array is not None:
+                self.live_bands[key] = band
+                self.live_bands.move_to_end(key)
+            else:
+                self.live_bands.pop(key, None)
+                band.array = None
+            while len(self.live_bands) > MAX_BANDS:
+                _, oldest = self.live_bands.popitem(last=False)
+                oldest.array = None
+                oldest.dropped = True
 
-    start_time = time.time()
+    def load_tile(self, index):
+        # Read a tile to send it. Outputs finished on the source image get its
+        # core now, so the image isn't read again to finish them.
+        part = self.read_tile(index)
+        tile = self.tiles[index]
+        for key in SOURCE_OUTPUTS:
+            self.canvases[key].place(tile, crop_halo(part, tile)[:, :, ::-1])
+        return part
 
-    # Use ThreadPoolExecutor to send parts to servers in parallel
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(process_part_parallel, server, part, i) for i, (server, part) in enumerate(zip(servers, parts))]
-        for future in concurrent.futures.as_completed(futures):
-            index, processed_images = future.result()  # Get the index and processed images
-            for key in processed_parts:
-                processed_parts[key][index] = processed_images[key]  # Store the processed part in the correct position
+    def follow(self, index, part):
+        # True if `part` repeats a tile already sent: this tile then takes that
+        # tile's outputs, those stored so far now and the rest as they arrive
+        tile = self.tiles[index]
+        group = (tile_key(part, self.outputs, tile_core(tile)), tile.top, tile.bottom, tile.left, tile.right)
+        with self.lock:
+            leader = self.leaders.setdefault(group, index)
+            if leader == index:
+                return False
+            self.followers.setdefault(leader, []).append(index)
+            placed = list(self.placed.get(leader, ()))
+        with self.times.measure("stitch"):
+            for key in placed:
+                self._copy_output(leader, index, key)
+        return True
 
-    total_processing_time = time.time() - start_time
+    def repeats(self):
+        return sum(len(followers) for followers in self.followers.values())
 
-    # Concatenate and save all final processed images
-    for key in processed_parts:
-        final_image = concatenate_image(processed_parts[key])
-        final_image_path = os.path.join(OUTPUT_DIR, f"final_{key}_image.png")
+    def store_output(self, index, key, part):
+        # Called as each output of a tile arrives, while the server still computes the rest
+        with self.times.measure("stitch"):
+            self._store_output(index, key, part)
+            # Only once the output is in place, so followers arriving later can copy it
+            with self.lock:
+                self.placed.setdefault(index, set()).add(key)
+                followers = list(self.followers.get(index, ()))
+            for follower in followers:
+                self._store_output(follower, key, part)
+
+    def _store_output(self, index, key, part):
+        tile = self.tiles[index]
+        if key in self.partials:
+            self.partials[key][index] = part
+        elif key in self.level_canvases:
+            # Pyramid levels cover only the tile's core already
+            self.level_canvases[key].place(scale_tile(tile, parse_level(key)[1]), part)
+        else:
+            cropped = part if key in UNALIGNED_OUTPUTS else crop_halo(part, tile)  # Drop the ghost border
+            self.canvases[key].place(tile, cropped)  # Copy the processed part into its position
+
+    def _copy_output(self, leader, index, key):
+        # Copy an output already stored for `leader` to the identical tile `index`
+        if key in self.partials:
+            self.partials[key][index] = self.partials[key][leader]
+        elif key in self.level_canvases:
+            level = parse_level(key)[1]
+            canvas = self.level_canvases[key]
+            canvas.place(scale_tile(self.tiles[index], level), canvas.region(scale_tile(self.tiles[leader], level)))
+        else:
+            canvas = self.canvases[key]
+            canvas.place(self.tiles[index], canvas.region(self.tiles[leader]))
+
+    def finish(self):
+        # Second phase: reduce the partial statistics and finish the outputs
+        # that depend on the whole image
+        with self.times.measure("stitch"):
+            finish_outputs(OUTPUT_KEYS, self.tiles, self.partials, self.canvases, self.raster)
+
+    def pyramid_levels(self, key):
+        # Every level of the output's pyramid, full size first
+        levels = [self.canvases[key].array]
+        for level in range(1, self.levels + 1):
+            canvas = self.level_canvases.get(level_name(key, level))
+            if canvas is None:
+                break
+            levels.append(canvas.array)
+        return complete_levels(levels)
+
+    def close(self):
+        for canvas in list(self.canvases.values()) + list(self.level_canvases.values()):
+            canvas.close()
+        if self.scratch is not None:
+            os.rmdir(self.scratch)
+
+def process_remote(pool, servers, image_job, in_flight):
+    # Route each tile to the server its position hashes to, so the same tile
+    # of an image processed again at the same tile size hits that server's
+    # result cache, with no server taking much more than its share. Routing
+    # is by position, not content (see routing.position_key).
+    # Servers pull tiles from per-server queues until every tile is processed,
+    # keeping up to `in_flight` tiles pipelined on their connection. Tiles on
+    # a failed or hung server are retried elsewhere, and stragglers get a
+    # duplicate on an idle server (see scheduler.py for the limits).
+    homes = assign([position_key(tile) for tile in image_job.tiles], servers)
+    return process_tiles(servers, list(range(len(image_job.tiles))), functools.partial(process_part_parallel, pool, image_job),
+                         depth=in_flight, homes=homes)
+
+def save_outputs(image_job, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Save the original image, unless it was streamed and isn't in memory
+    if hasattr(image_job.raster, "image"):
+        original_image_path = os.path.join(output_dir, "original_image.png")
+        cv2.imwrite(original_image_path, cv2.cvtColor(image_job.raster.image, cv2.COLOR_RGB2BGR))
+        print(f"Saved original image to {original_image_path}")
+
+    # Save all final processed images straight from their canvases
+    for key in OUTPUT_KEYS:
+        final_image = image_job.canvases[key].array
+        if final_image is None:
+            print(f"No {key} output arrived for {image_job.path}")
+            continue
+        final_image_path = os.path.join(output_dir, f"final_{key}_image.png")
         cv2.imwrite(final_image_path, final_image)
         print(f"Saved final {key} image to {final_image_path}")
 
-    print(f"Total processing time: {total_processing_time:.2f} seconds")
\ No newline at end of file
+    # Deep-zoom pyramids, next to the images they were built from
+    for key in image_job.pyramid:
+        if image_job.canvases[key].array is None:
+            continue
+        base = os.path.join(output_dir, f"final_{key}_image")
+        write_pyramid(base, image_job.pyramid_levels(key))
+        print(f"Saved deep-zoom pyramid of {key} to {base}.dzi")
+
+def process_batch(paths, pool, servers, output_dir, tile_size, in_flight, window, canvas_dir=None, pyramid=(), tracer=None):
+    # Up to `window` images are in the client at once, each on its own thread
+    # going through load and split, remote processing, then stitch and save.
+    # Staggered across images, those stages overlap: image k+1 loads while
+    # image k is on the servers and image k-1 is being written. With a single
+    # image its outputs go straight into output_dir, otherwise into a
+    # subdirectory per image. An image that fails is reported and the rest
+    # of the batch carries on. Returns the number of source pixels processed,
+    # the seconds spent per stage, summed over images and threads, and the
+    # error of each image that failed, by path. "remote" is the wall-clock
+    # time tiles were out, and the stages within it (encode, round_trip per
+    # tile, decode, stitch) overlap. Images sampled by `tracer` (a
+    # tracing.Tracer) are traced through clients and servers.
+    single = len(paths) == 1
+    times = StageTimes()
+
+    def run(path):
+        start = time.time()
+        started = time.perf_counter()
+        trace = tracer.start(path) if tracer is not None else None
+        image_times = TracedTimes(times, trace) if trace is not None else times
+        with image_times.measure("load"):
+            raster = open_raster(path)
+        image_job = None
+        try:
+            with image_times.measure("split"):
+                image_job = ImageJob(path, raster, tile_size, canvas_dir, pyramid, image_times)
+            with image_times.measure("remote"):
+                tiles_per_server = process_remote(pool, servers, image_job, in_flight)
+            for (host, port), count in tiles_per_server.items():
+                print(f"Server {host}:{port} processed {count} tiles of {path}")
+            if image_job.repeats():
+                print(f"{image_job.repeats()} tiles of {path} repeated others and were not sent")
+            image_job.finish()
+            name = os.path.splitext(os.path.basename(path))[0]
+            with image_times.measure("write"):
+                save_outputs(image_job, output_dir if single else os.path.join(output_dir, name))
+        finally:
+            if image_job is not None:
+                image_job.close()
+            raster.close()
+        seconds = time.perf_counter() - started
+        if trace is not None:
+            trace.record("image", start, seconds, {"path": path})
+        print(f"Processed {path} in {seconds:.2f} seconds")
+        return raster.shape[0] * raster.shape[1]
+
+    pixels = 0
+    failed = {}
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        futures = {executor.submit(run, path): path for path in paths}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                pixels += future.result()
+            except Exception as e:
+                print(f"Failed to process {path}: {type(e).__name__}: {e}")
+                failed[path] = e
+    return pixels, times.snapshot(), failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process images on the distributed servers")
+    parser.add_argument("inputs", nargs="*", default=["santanu.tiff"], help="image files, directories or glob patterns")
+    parser.add_argument("--output-dir", default="client_output")
+    parser.add_argument("--window", type=int, default=3, help="images in the client at once")
+    parser.add_argument("--registry", type=parse_address, default=('127.0.0.1', 65431), help="host:port of the registry")
+    parser.add_argument("--max-servers", type=int, default=None, help="use at most this many of the live servers")
+    parser.add_argument("--tile-size", type=int, default=512)
+    parser.add_argument("--in-flight", type=int, default=2, help="tiles pipelined on each server's connection per image")
+    # "auto" picks per payload from link and encode speed; otherwise "raw" or
+    # a codec with a level such as "zlib:1", "png:3", "lzma:0" or "zstd:3"
+    parser.add_argument("--codec", default="auto")
+    parser.add_argument("--canvas-dir", default=None,
+                        help="assemble outputs in memory-mapped scratch files here instead of in RAM, for outputs bigger than memory")
+    parser.add_argument("--pyramid", default="",
+                        help='comma-separated outputs to also save as deep-zoom pyramids (.dzi), or "all"')
+    parser.add_argument("--trace", default=None,
+                        help="trace images across client and servers and write the timeline here as Chrome trace-event JSON")
+    parser.add_argument("--trace-sample", type=float, default=1.0, help="fraction of images traced with --trace")
+    args = parser.parse_args()
+    pyramid = OUTPUT_KEYS if args.pyramid == "all" else [key for key in args.pyramid.split(",") if key]
+    unknown = [key for key in pyramid if key not in OUTPUT_KEYS]
+    if unknown:
+        parser.error(f"unknown outputs for --pyramid: {', '.join(unknown)}")
+
+    paths = expand_inputs(args.inputs)
+    if not paths:
+        raise SystemExit(f"No images found in {' '.join(args.inputs)}")
+
+    # Ask the registry which servers are alive, least loaded first
+    live_servers = lookup_servers(args.registry, args.max_servers)
+    if not live_servers:
+        raise SystemExit(f"No live servers registered with {args.registry[0]}:{args.registry[1]}")
+    servers = [tuple(server["address"]) for server in live_servers]
+    for server in live_servers:
+        host, port = server["address"]
+        print(f"Using server {host}:{port} ({server['in_flight']} tiles in flight, {server['queued']} queued, "
+              f"{server['pixels_per_second'] / 1e6:.1f} MPix/s)")
+
+    tracer = Tracer(args.trace_sample) if args.trace else None
+    start_time = time.perf_counter()
+    with ConnectionPool(codec=args.codec) as pool:
+        pixels, stage_times, failed = process_batch(paths, pool, servers, args.output_dir, args.tile_size, args.in_flight, args.window,
+                                           args.canvas_dir, pyramid, tracer)
+    total_processing_time = time.perf_counter() - start_time
+    if tracer is not None:
+        print(f"Wrote {tracer.export(args.trace)} trace spans to {args.trace}")
+
+    print("Time per stage, summed over images and threads: "
+          + ", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in stage_times.items() if not stage.startswith("op_")))
+    ops = sorted(((seconds, stage[len("op_"):]) for stage, seconds in stage_times.items() if stage.startswith("op_")), reverse=True)
+    print("Server time per op, slowest first: " + ", ".join(f"{op} {seconds:.2f} s" for seconds, op in ops))
+    processed = len(paths) - len(failed)
+    print(f"Processed {processed} images ({pixels / 1e6:.1f} MPix) at {processed / total_processing_time:.2f} images/s, "
+          f"{pixels / 1e6 / total_processing_time:.2f} MPix/s")
+    print(f"Total processing time: {total_processing_time:.2f} seconds")
+    if failed:
+        print(f"{len(failed)} images failed: " + ", ".join(path for path in paths if path in failed))
+        sys.exit(1)
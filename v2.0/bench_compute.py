@@ -0,0 +1,67 @@
+import argparse
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from compute import make_backend, default_workers
+from codec import make_codec
+from protocol import encode_arrays
+
+# Measures server-side tile throughput for each compute backend as the worker
+# count grows. Each tile goes through the same steps as on the server: the
+# pipeline, then encoding of every output as it is produced.
+
+def make_tiles(count, size, seed=0):
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+    # Smooth the noise a little so codecs see image-like data
+    base = ((base.astype(np.uint16) + np.roll(base, 1, axis=0) + np.roll(base, 1, axis=1)) // 3).astype(np.uint8)
+    return [np.roll(base, i * 7, axis=1) for i in range(count)]
+
+def run_tile(backend, codec, tile):
+    sent = [0]
+
+    def encode_output(key, array):
+        sent[0] += sum(memoryview(buffer).nbytes for buffer in encode_arrays({key: array}, codec))
+
+    backend.run(tile, encode_output)
+    return sent[0]
+
+def bench(backend_name, workers, tiles, codec_spec):
+    backend = make_backend(backend_name, workers)
+    codec = make_codec(codec_spec)
+    try:
+        # Warm up every worker once before timing
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda tile: run_tile(backend, codec, tile), tiles[:workers]))
+            start = time.perf_counter()
+            list(executor.map(lambda tile: run_tile(backend, codec, tile), tiles))
+            elapsed = time.perf_counter() - start
+    finally:
+        backend.close()
+    pixels = sum(tile.shape[0] * tile.shape[1] for tile in tiles)
+    return len(tiles) / elapsed, pixels / elapsed / 1e6
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the compute backends")
+    parser.add_argument("--tile-size", type=int, default=512)
+    parser.add_argument("--tiles", type=int, default=64)
+    parser.add_argument("--workers", type=int, nargs="+", default=None, help="worker counts to try (default: powers of two up to the CPU count)")
+    parser.add_argument("--backends", nargs="+", default=["thread", "blocks", "process"])
+    parser.add_argument("--codec", default="zlib:1")
+    args = parser.parse_args()
+
+    counts = args.workers
+    if counts is None:
+        counts = [1]
+        while counts[-1] * 2 <= default_workers():
+            counts.append(counts[-1] * 2)
+
+    tiles = make_tiles(args.tiles, args.tile_size)
+    print(f"{args.tiles} tiles of {args.tile_size}x{args.tile_size}, codec {args.codec}")
+    print(f"{'backend':<10}{'workers':>8}{'tiles/s':>10}{'MPix/s':>10}{'speedup':>9}")
+    for backend_name in args.backends:
+        baseline = None
+        for workers in counts:
+            tiles_per_second, mpix_per_second = bench(backend_name, workers, tiles, args.codec)
+            baseline = baseline or tiles_per_second
+            print(f"{backend_name:<10}{workers:>8}{tiles_per_second:>10.2f}{mpix_per_second:>10.2f}{tiles_per_second / baseline:>8.2f}x")
@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+import contextlib
+import numpy as np
+import cv2
+from PIL import Image
+from pipeline import process_image
+from centaralized import save_processed_images
+from tiling import tiles_of_size
+from timing import StageTimes
+from transport import ConnectionPool
+from registry import lookup_servers
+from Client import process_batch
+
+# Runs the whole job end to end, centralized (one process, as in
+# centaralized.py) and distributed (local servers, as with Client.py), over a
+# sweep of image sizes, tile sizes, server counts, compute workers per server
+# and codecs. Every run is split into the stages below; distributed stages
+# are seconds summed over the client's threads and every server's compute
+# workers, so they overlap and can add up to more than the run's wall-clock
+# total. "transfer" is the time tiles spent on the way to and from servers:
+# the round trips minus the time each server reports between having the tile
+# and answering. The servers' own stages and per-op times come back with
+# every response and are kept under "server". Results are written as JSON so
+# runs can be diffed.
+STAGES = ["load", "split", "encode", "transfer", "decode", "compute", "serialize", "stitch", "write"]
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def make_image(height, width, seed=0):
+    # Smoothed noise, so codecs see image-like data
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    return cv2.GaussianBlur(base, (0, 0), 2)
+
+def prepare_images(sources, sizes, directory):
+    # Writes every source at every size (its longer side) as an uncompressed
+    # TIFF, which the client streams. "synthetic" is a square of smoothed noise.
+    images = []
+    for source in sources:
+        name = "synthetic" if source == "synthetic" else os.path.splitext(os.path.basename(source))[0]
+        original = None if source == "synthetic" else cv2.imread(source)
+        if source != "synthetic" and original is None:
+            raise SystemExit(f"Failed to load {source}")
+        for size in sizes:
+            if original is None:
+                image = make_image(size, size)
+            else:
+                scale = size / max(original.shape[:2])
+                dsize = (max(1, round(original.shape[1] * scale)), max(1, round(original.shape[0] * scale)))
+                image = cv2.resize(original, dsize, interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+            path = os.path.join(directory, f"{name}_{size}.tiff")
+            Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)).save(path)
+            images.append({"name": name, "size": list(image.shape[:2]), "path": path})
+    return images
+
+class LocalCluster:
+    # A registry and `count` servers on this machine, each in its own
+    # process. The result cache is off so repeated runs really compute.
+    def __init__(self, count, base_port, directory, compute_workers=None):
+        self.count = count
+        self.registry = ("127.0.0.1", base_port)
+        self.processes = []
+        self.logs = []
+        try:
+            self._start([sys.executable, "registry.py", "--port", str(base_port)], os.path.join(directory, "registry.log"))
+            for i in range(count):
+                command = [sys.executable, "server.py", "--port", str(base_port + 1 + i), "--no-save", "--cache-mb", "0",
+                           "--registry", f"127.0.0.1:{base_port}"]
+                if compute_workers:
+                    command += ["--compute-workers", str(compute_workers)]
+                self._start(command, os.path.join(directory, f"server{i + 1}.log"))
+            self._wait_until_live()
+        except BaseException:
+            self.close()
+            raise
+
+    def _start(self, command, log_path):
+        log = open(log_path, "w")
+        self.logs.append(log)
+        self.processes.append(subprocess.Popen(command, cwd=HERE, stdout=log, stderr=subprocess.STDOUT))
+
+    def _wait_until_live(self, timeout=30):
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            try:
+                if len(lookup_servers(self.registry)) == self.count:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"{self.count} servers did not register within {timeout} seconds")
+
+    def servers(self):
+        return [tuple(server["address"]) for server in lookup_servers(self.registry)]
+
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for log in self.logs:
+            log.close()
+
+def run_centralized(path, output_dir):
+    times = StageTimes()
+    started = time.perf_counter()
+    with times.measure("load"):
+        image = cv2.imread(path)
+    with times.measure("compute"):
+        processed_images = process_image(image)
+    with times.measure("write"):
+        os.makedirs(output_dir, exist_ok=True)
+        save_processed_images(processed_images, output_dir)
+    total = time.perf_counter() - started
+    return dict(times.snapshot(), total=total)
+
+def run_distributed(path, cluster, output_dir, tile_size, codec, in_flight):
+    started = time.perf_counter()
+    with ConnectionPool(codec=codec) as pool:
+        _, client, failed = process_batch([path], pool, cluster.servers(), output_dir, tile_size, in_flight, 1)
+    if failed:
+        raise failed[path]
+    total = time.perf_counter() - started
+    server = {stage[len("server_"):]: seconds for stage, seconds in client.items() if stage.startswith("server_")}
+    stages = {stage: client.get(stage, 0.0) for stage in ("load", "split", "encode", "transfer", "stitch", "write")}
+    stages["decode"] = client.get("decode", 0.0) + server.get("decode", 0.0)
+    stages["compute"] = server.get("compute", 0.0)
+    stages["serialize"] = server.get("serialize", 0.0)
+    return dict(stages, remote=client.get("remote", 0.0), total=total, server=server,
+                ops={stage[len("op_"):]: seconds for stage, seconds in client.items() if stage.startswith("op_")})
+
+def measure(run, warmup, repeats):
+    # Warm-up runs load code and caches and aren't recorded
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(warmup):
+            run()
+        runs = [run() for _ in range(repeats)]
+    summary = {}
+    for key, value in runs[0].items():
+        if isinstance(value, dict):
+            summary[key] = {name: statistics.median(r[key].get(name, 0.0) for r in runs) for name in value}
+        else:
+            summary[key] = statistics.median(r.get(key, 0.0) for r in runs)
+    return runs, summary
+
+def report(result):
+    median = result["median"]
+    pixels = result["size"][0] * result["size"][1]
+    setup = "" if result["mode"] == "centralized" else (
+        f" {result['tiles']} tiles, {result['servers']} servers x {result['compute_workers'] or 'default'} workers, {result['codec']}")
+    print(f"{result['mode']:<12}{result['image']:<12}{result['size'][1]}x{result['size'][0]}{setup}: "
+          f"{median['total']:.3f} s, {pixels / 1e6 / median['total']:.2f} MPix/s")
+    print("    " + ", ".join(f"{stage} {median.get(stage, 0.0):.3f}" for stage in STAGES))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the centralized and distributed paths end to end")
+    parser.add_argument("--images", nargs="+", default=["synthetic", "sea.tiff"], help='image files, or "synthetic"')
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 2048], help="longer side of each image, in pixels")
+    parser.add_argument("--tile-sizes", type=int, nargs="+", default=[256, 512])
+    parser.add_argument("--servers", type=int, nargs="+", default=[1, 2, 4], help="server counts to try")
+    parser.add_argument("--compute-workers", type=int, nargs="+", default=[0],
+                        help="compute workers per server to try, 0 for the server's default")
+    parser.add_argument("--codecs", nargs="+", default=["raw", "zlib:1", "auto"])
+    parser.add_argument("--in-flight", type=int, default=2)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--base-port", type=int, default=47000, help="registry port; servers use the ports after it")
+    parser.add_argument("--output", default="bench_e2e.json")
+    parser.add_argument("--keep", action="store_true", help="keep the generated images, outputs and server logs")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bench_e2e_")
+    results = []
+    try:
+        images = prepare_images(args.images, args.sizes, directory)
+        output_dir = os.path.join(directory, "output")
+        for image in images:
+            runs, median = measure(lambda: run_centralized(image["path"], output_dir), args.warmup, args.repeats)
+            results.append({"mode": "centralized", "image": image["name"], "size": image["size"], "runs": runs, "median": median})
+            report(results[-1])
+
+        for count in args.servers:
+            for workers in args.compute_workers:
+                cluster = LocalCluster(count, args.base_port, directory, workers)
+                try:
+                    for image in images:
+                        height, width = image["size"]
+                        for tile_size in args.tile_sizes:
+                            for codec in args.codecs:
+                                runs, median = measure(lambda: run_distributed(image["path"], cluster, output_dir, tile_size, codec,
+                                                                               args.in_flight), args.warmup, args.repeats)
+                                results.append({"mode": "distributed", "image": image["name"], "size": image["size"],
+                                                "tile_size": tile_size, "tiles": len(tiles_of_size(height, width, tile_size, tile_size)),
+                                                "servers": count, "compute_workers": workers or None, "codec": codec,
+                                                "runs": runs, "median": median})
+                                report(results[-1])
+                finally:
+                    cluster.close()
+    finally:
+        if args.keep:
+            print(f"Kept images, outputs and logs in {directory}")
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count(),
+                        "opencv": cv2.__version__, "numpy": np.__version__},
+            "settings": vars(args),
+            "stages": STAGES,
+            "results": results,
+        }, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
@@ -0,0 +1,235 @@
+import sys
+import json
+import math
+import time
+import platform
+import argparse
+import statistics
+import concurrent.futures
+import multiprocessing as mp
+import numpy as np
+import cv2
+from pipeline import OPS, SOURCES, build_plan
+from bench_e2e import make_image
+
+# Times every op of the pipeline by itself across a matrix of image sizes and
+# channel counts, and compares runs against a stored baseline. Each op gets
+# its real inputs (the outputs of the ops before it on the same image), then
+# is called in batches long enough to time reliably. Ops are timed in rounds,
+# each in a new process, that take every op in turn; the median per-call
+# time of an op's batches in a round is one sample of it.
+#
+#   python bench_ops.py run --output baseline.json
+#   python bench_ops.py compare baseline.json            # against a fresh run
+#   python bench_ops.py compare baseline.json current.json
+#
+# compare flags an op as a regression when its rounds are slower with
+# statistical significance (a one-sided Mann-Whitney U test at --alpha) and
+# its median is slower by more than --threshold and by more than the spread
+# of either run's rounds; it exits with status 1 if any are. Batches of one
+# round share the process and the machine's state at that moment, so only
+# whole rounds count as independent samples.
+
+DEFAULT_FILE = "bench_ops.json"
+
+def op_inputs(height, width, channels, names):
+    # Every value the named ops need, computed once from a synthetic image.
+    # Ops that can't take this many channels are left out.
+    image = make_image(height, width)
+    if channels == 1:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)[:, :, None]
+    elif channels == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+    values = {"image": image, "core": (0, 0, height, width)}
+    unsupported = {}
+    for name, inputs, fn, _ in build_plan(tuple(names)):
+        missing = [dep for dep in inputs if dep not in values]
+        if missing:
+            unsupported[name] = f"needs {', '.join(missing)}"
+            continue
+        try:
+            values[name] = fn(*(values[dep] for dep in inputs))
+        except (cv2.error, ValueError, IndexError) as e:
+            unsupported[name] = f"{type(e).__name__}: {str(e).strip().splitlines()[-1]}"
+    return values, unsupported
+
+def time_op(fn, args, samples, min_time):
+    # Per-call seconds from `samples` batches, each batch at least `min_time`
+    # long; the batch size is picked from a first timed call
+    started = time.perf_counter()
+    fn(*args)
+    first = time.perf_counter() - started
+    number = max(1, int(min_time / max(first, 1e-9)))
+    times = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn(*args)
+        times.append((time.perf_counter() - started) / number)
+    return times
+
+def time_round(sizes, channel_counts, names, samples, min_time, threads):
+    # One round: every op on every image once, as
+    # {(op, size, channels): per-call times of its batches}, plus the ops
+    # skipped with why
+    if threads is not None:
+        cv2.setNumThreads(threads)
+    times, skipped = {}, {}
+    for size in sizes:
+        for channels in channel_counts:
+            values, unsupported = op_inputs(size, size, channels, names)
+            for name, inputs, fn, _ in build_plan(tuple(names)):
+                if name not in names:
+                    continue
+                if name in unsupported:
+                    skipped[(name, size, channels)] = unsupported[name]
+                else:
+                    times[(name, size, channels)] = time_op(fn, [values[dep] for dep in inputs], samples, min_time)
+    return times, skipped
+
+def run(sizes, channel_counts, names, rounds, samples, min_time, threads=None):
+    # Each round runs in a fresh process, so rounds differ the way separate
+    # runs do (memory layout, OpenCV's thread pool, the machine's load at the
+    # time) and their spread shows how much a run can move on its own
+    context = mp.get_context("spawn")
+    measured = []
+    for number in range(rounds):
+        print(f"Round {number + 1} of {rounds}")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            measured.append(executor.submit(time_round, sizes, channel_counts, names, samples, min_time, threads).result())
+    results = []
+    for (name, size, channels), reason in measured[0][1].items():
+        print(f"{name:<22}{size:>6}{channels:>3}  skipped ({reason})")
+        results.append({"op": name, "size": size, "channels": channels, "skipped": reason})
+    for (name, size, channels) in measured[0][0]:
+        batches = [times[(name, size, channels)] for times, _ in measured]
+        entry = {"op": name, "size": size, "channels": channels,
+                 "rounds": [statistics.median(times) for times in batches],
+                 "samples": [seconds for times in batches for seconds in times]}
+        entry["median"] = statistics.median(entry["rounds"])
+        print(f"{name:<22}{size:>6}{channels:>3}{entry['median'] * 1e3:>11.3f} ms"
+              f"{size * size / entry['median'] / 1e6:>10.1f} MPix/s")
+        results.append(entry)
+    return results
+
+def mann_whitney_greater(current, baseline):
+    # One-sided p-value that `current` tends to be larger than `baseline`,
+    # from the normal approximation of the U statistic with tie correction
+    combined = sorted([(value, 0) for value in current] + [(value, 1) for value in baseline])
+    ranks = [0.0] * len(combined)
+    ties = 0.0
+    i = 0
+    while i < len(combined):
+        j = i
+        while j + 1 < len(combined) and combined[j + 1][0] == combined[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2 + 1
+        ties += (j - i + 1) ** 3 - (j - i + 1)
+        i = j + 1
+    n1, n2 = len(current), len(baseline)
+    u = sum(rank for rank, (_, group) in zip(ranks, combined) if group == 0) - n1 * (n1 + 1) / 2
+    n = n1 + n2
+    variance = n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    z = (u - n1 * n2 / 2 - 0.5) / math.sqrt(variance)
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+def spread(rounds):
+    # How far apart an op's rounds are, relative to their median
+    return (max(rounds) - min(rounds)) / statistics.median(rounds)
+
+def compare(baseline, current, alpha, threshold):
+    # Returns the entries that regressed
+    previous = {(entry["op"], entry["size"], entry["channels"]): entry for entry in baseline["results"]}
+    regressions = []
+    without_rounds = 0
+    print(f"{'op':<22}{'size':>6}{'ch':>3}{'baseline':>12}{'current':>12}{'change':>9}{'spread':>9}{'p':>9}")
+    for entry in current["results"]:
+        old = previous.get((entry["op"], entry["size"], entry["channels"]))
+        if old is None or "skipped" in old or "skipped" in entry:
+            continue
+        if "rounds" not in old or "rounds" not in entry:
+            without_rounds += 1
+            continue
+        change = entry["median"] / old["median"] - 1
+        noise = max(spread(old["rounds"]), spread(entry["rounds"]))
+        p = mann_whitney_greater(entry["rounds"], old["rounds"])
+        regressed = p < alpha and change > max(threshold, noise)
+        if regressed:
+            regressions.append(entry)
+        print(f"{entry['op']:<22}{entry['size']:>6}{entry['channels']:>3}{old['median'] * 1e3:>9.3f} ms"
+              f"{entry['median'] * 1e3:>9.3f} ms{change:>+9.1%}{noise:>9.1%}{p:>9.4f}" + ("  REGRESSION" if regressed else ""))
+    if without_rounds:
+        print(f"Skipped {without_rounds} results recorded without rounds; run the baseline again")
+    return regressions
+
+def environment():
+    return {"platform": platform.platform(), "python": platform.python_version(), "opencv": cv2.__version__,
+            "numpy": np.__version__, "opencv_threads": cv2.getNumThreads()}
+
+def add_run_options(parser):
+    parser.add_argument("--sizes", type=int, nargs="+", default=[256, 512, 1024, 2048], help="side of the square test images")
+    parser.add_argument("--channels", type=int, nargs="+", choices=[1, 3, 4], default=[3], help="channel counts of the source image")
+    parser.add_argument("--ops", nargs="+", default=None, help="ops to time (default: all registered)")
+    parser.add_argument("--rounds", type=int, default=5, help="rounds of timing every op in turn")
+    parser.add_argument("--samples", type=int, default=5, help="timed batches per op in each round")
+    parser.add_argument("--min-time", type=float, default=0.02, help="seconds each batch runs for at least")
+    parser.add_argument("--threads", type=int, default=None, help="OpenCV threads (default: OpenCV's own choice)")
+
+def run_from_args(args):
+    if args.threads is not None:
+        cv2.setNumThreads(args.threads)
+    names = args.ops or [name for name in OPS if name not in SOURCES]
+    unknown = [name for name in names if name not in OPS]
+    if unknown:
+        raise SystemExit(f"Unknown ops: {', '.join(unknown)}")
+    results = run(args.sizes, args.channels, names, args.rounds, args.samples, args.min_time, args.threads)
+    settings = {"sizes": args.sizes, "channels": args.channels, "ops": names, "rounds": args.rounds, "samples": args.samples,
+                "min_time": args.min_time, "threads": args.threads}
+    return {"created": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "environment": environment(), "settings": settings,
+            "results": results}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmark each pipeline op and compare against a baseline")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="time every op and save the results")
+    add_run_options(run_parser)
+    run_parser.add_argument("--output", default=DEFAULT_FILE)
+    compare_parser = commands.add_parser("compare", help="flag ops that got slower than in a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current", nargs="?", default=None,
+                                help="results to check (default: a fresh run with the baseline's settings)")
+    compare_parser.add_argument("--alpha", type=float, default=0.01, help="significance level of the test")
+    compare_parser.add_argument("--threshold", type=float, default=0.05, help="smallest slowdown worth flagging, as a fraction")
+    compare_parser.add_argument("--output", default=None, help="also save the fresh run here")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run_from_args(args)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved {len(results['results'])} results to {args.output}")
+        sys.exit(0)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if args.current is not None:
+        with open(args.current) as f:
+            current = json.load(f)
+    else:
+        # Measure again the same way the baseline was measured
+        settings = baseline["settings"]
+        current = run_from_args(argparse.Namespace(sizes=settings["sizes"], channels=settings["channels"], ops=settings["ops"],
+                                                   rounds=settings.get("rounds", 5), samples=settings["samples"],
+                                                   min_time=settings["min_time"], threads=settings["threads"]))
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump(current, f, indent=2)
+    for key in ("opencv", "numpy", "python"):
+        if baseline["environment"].get(key) != current["environment"].get(key):
+            print(f"Note: {key} {baseline['environment'].get(key)} in the baseline, {current['environment'].get(key)} now")
+    regressions = compare(baseline, current, args.alpha, args.threshold)
+    print(f"{len(regressions)} regressions at alpha {args.alpha}, threshold {args.threshold:.0%}")
+    sys.exit(1 if regressions else 0)
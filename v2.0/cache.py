@@ -0,0 +1,125 @@
+import os
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import OUTPUT_KEYS, PIPELINE_VERSION
+
+# Default memory budget of a server's result cache
+CACHE_BYTES = 256 * 1024 * 1024
+
+def tile_key(image, outputs=None, core=None):
+    # Content address of a tile's results: a hash of its pixels, shape and
+    # dtype together with the pipeline version, the outputs requested and the
+    # core region partial statistics are taken over. Clients use it to find
+    # repeated tiles; servers key their cache by request_key, which uses it.
+    digest = hashlib.blake2b(digest_size=16)
+    outputs = OUTPUT_KEYS if outputs is None else outputs
+    core = tuple(core) if core is not None else (0, 0) + image.shape[:2]
+    digest.update(f"{PIPELINE_VERSION}|{image.dtype.str}|{image.shape}|{','.join(outputs)}|{core}".encode("utf-8"))
+    digest.update(memoryview(np.ascontiguousarray(image)).cast("B"))
+    return digest.digest()
+
+def request_key(request):
+    # Cache key of a decoded tile request, worked out by the server from what
+    # it received rather than trusted from the client: the tile_key of the
+    # pixels with the outputs and core region asked for. It is hashed from
+    # the decoded image, so the same tile gets the same key whichever codec
+    # carried it.
+    if "image" not in request:
+        return None
+    outputs = bytes(request["outputs"]).decode("utf-8").split(",") if "outputs" in request else None
+    core = tuple(int(value) for value in request["core"]) if "core" in request else None
+    return tile_key(request["image"], outputs, core)
+
+class ResultCache:
+    # Processed outputs of tiles seen before, keyed by request_key(). Entries are
+    # kept in memory up to `max_bytes`, evicting the least recently used one
+    # first. With a `directory`, every entry is also written there in the
+    # background as <key>.npz, so results outlive evictions and restarts and
+    # are shared by every server process using the same directory.
+    def __init__(self, max_bytes=CACHE_BYTES, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.disk = None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.disk = ThreadPoolExecutor(max_workers=1)
+
+    def _path(self, key):
+        name = key.hex()
+        return os.path.join(self.directory, name[:2], f"{name}.npz")
+
+    def get(self, key):
+        # Returns {output name: array} in the order they were produced, or None
+        with self.lock:
+            outputs = self.entries.get(key)
+            if outputs is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return outputs
+        outputs = self._load(key) if self.directory is not None else None
+        with self.lock:
+            if outputs is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._remember(key, outputs)
+        return outputs
+
+    def put(self, key, outputs):
+        # `outputs` must not be modified afterwards
+        self._remember(key, outputs)
+        if self.disk is not None:
+            self.disk.submit(self._store, key, outputs)
+
+    def _remember(self, key, outputs):
+        size = sum(array.nbytes for array in outputs.values())
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = outputs
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= sum(array.nbytes for array in evicted.values())
+
+    def _load(self, key):
+        try:
+            with np.load(self._path(key)) as data:
+                return {name: data[name] for name in data.files}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable cache entry {self._path(key)}: {e}")
+            return None
+
+    def _store(self, key, outputs):
+        # Write to a temporary name first so readers never see a partial file
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary, "wb") as f:
+                np.savez(f, **outputs)
+            os.replace(temporary, path)
+        except OSError as e:
+            print(f"Failed to store cache entry {path}: {e}")
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.shutdown()
+        print(f"Result cache: {self.hits} memory hits, {self.disk_hits} disk hits, {self.misses} misses, "
+              f"{len(self.entries)} entries using {self.bytes / 1e6:.1f} MB")
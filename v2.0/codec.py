@@ -0,0 +1,176 @@
+import time
+import zlib
+import lzma
+import cv2
+import numpy as np
+
+try:
+    from compression import zstd  # Python 3.14+
+except ImportError:
+    zstd = None
+
+# Codec ids as stored in each array header on the wire
+RAW = 0
+ZLIB = 1
+PNG = 2
+LZMA = 3
+ZSTD = 4
+
+CODEC_IDS = {"raw": RAW, "zlib": ZLIB, "png": PNG, "lzma": LZMA, "zstd": ZSTD}
+DEFAULT_LEVELS = {"raw": 0, "zlib": 6, "png": 3, "lzma": 0, "zstd": 3}
+
+# Payloads smaller than this are always sent raw; compressing them never pays off
+MIN_COMPRESS_BYTES = 16 * 1024
+# How many bytes of an array the auto codec test-compresses to estimate ratio and speed
+PROBE_BYTES = 256 * 1024
+# Re-probe an output after this many payloads in case its content changed
+PROBE_INTERVAL = 16
+
+def available_codecs():
+    names = ["raw", "zlib", "png", "lzma"]
+    if zstd is not None:
+        names.append("zstd")
+    return names
+
+def parse_codec(spec):
+    # "zlib:1" -> ("zlib", 1); "png" -> ("png", default level)
+    name, _, level = spec.partition(":")
+    if name not in CODEC_IDS:
+        raise ValueError(f"Unknown codec {spec}")
+    return name, int(level) if level else DEFAULT_LEVELS[name]
+
+def png_compatible(array):
+    return array.dtype in (np.uint8, np.uint16) and (array.ndim == 2 or (array.ndim == 3 and array.shape[2] in (1, 3, 4)))
+
+def encode_array(array, codec, level):
+    # Returns (codec actually used, encoded buffer)
+    if codec == PNG and not png_compatible(array):
+        codec = ZLIB
+    if codec == PNG:
+        ok, encoded = cv2.imencode('.png', array, [cv2.IMWRITE_PNG_COMPRESSION, level])
+        if not ok:
+            raise ValueError("PNG encoding failed")
+        return PNG, encoded
+    # Flattened to bytes first; memoryview can't cast arrays with no elements
+    data = memoryview(np.ascontiguousarray(array).reshape(-1).view(np.uint8))
+    if codec == RAW:
+        return RAW, data
+    if codec == ZLIB:
+        return ZLIB, zlib.compress(data, level)
+    if codec == LZMA:
+        return LZMA, lzma.compress(data, preset=level)
+    if codec == ZSTD and zstd is not None:
+        return ZSTD, zstd.compress(data, level)
+    raise ValueError(f"Unsupported codec {codec}")
+
+def decode_array(data, dtype, shape, codec):
+    if codec == RAW:
+        return np.frombuffer(data, dtype=dtype).reshape(shape)
+    if codec == PNG:
+        array = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if array is None:
+            raise ValueError("Failed to decode image")
+        return array.reshape(shape)
+    if codec == ZLIB:
+        raw = zlib.decompress(data)
+    elif codec == LZMA:
+        raw = lzma.decompress(data)
+    elif codec == ZSTD and zstd is not None:
+        raw = zstd.decompress(data)
+    else:
+        raise ValueError(f"Unsupported codec {codec}")
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+class LinkEstimator:
+    # Moving average of how fast large frames arrive on a connection, in bytes/s.
+    # Starts from a guess (1 GbE) until real transfers have been measured.
+    def __init__(self, throughput=125e6, weight=0.3):
+        self.throughput = throughput
+        self.weight = weight
+
+    def record(self, nbytes, seconds):
+        if nbytes >= MIN_COMPRESS_BYTES and seconds > 0:
+            self.throughput += self.weight * (nbytes / seconds - self.throughput)
+
+class FixedCodec:
+    # Uses the same codec and level for every array
+    def __init__(self, name, level):
+        self.spec = f"{name}:{level}"
+        self.codec = CODEC_IDS[name]
+        self.level = level
+
+    def choose(self, name, array):
+        return self.codec, self.level
+
+class AutoCodec:
+    # Picks per array whichever of raw or a fast compressor should get the
+    # bytes to the other side soonest: encode time plus compressed size over the
+    # measured link throughput, against raw size over that throughput. The
+    # ratio and speed of each compressor are measured on a sample of the array.
+    spec = "auto"
+
+    def __init__(self, link, allowed=None):
+        self.link = link
+        self.allowed = set(available_codecs() if allowed is None else allowed)
+        self.stats = {}
+
+    def candidates(self, array):
+        candidates = []
+        if "zlib" in self.allowed:
+            candidates.append((ZLIB, 1))
+        if "png" in self.allowed and png_compatible(array):
+            candidates.append((PNG, 1))
+        if "zstd" in self.allowed and zstd is not None:
+            candidates.append((ZSTD, 1))
+        return candidates
+
+    def probe(self, array):
+        rows = max(1, min(array.shape[0], PROBE_BYTES * array.shape[0] // max(array.nbytes, 1)))
+        start = (array.shape[0] - rows) // 2
+        sample = np.ascontiguousarray(array[start:start + rows])
+        results = {}
+        for codec, level in self.candidates(array):
+            started = time.perf_counter()
+            _, encoded = encode_array(sample, codec, level)
+            elapsed = max(time.perf_counter() - started, 1e-6)
+            results[(codec, level)] = (memoryview(encoded).nbytes / sample.nbytes, sample.nbytes / elapsed)
+        return results
+
+    def choose(self, name, array):
+        nbytes = array.nbytes
+        if nbytes < MIN_COMPRESS_BYTES:
+            return RAW, 0
+        key = (name, array.dtype.str, array.ndim)
+        entry = self.stats.get(key)
+        if entry is None or entry[1] >= PROBE_INTERVAL:
+            entry = [self.probe(array), 0]
+            self.stats[key] = entry
+        entry[1] += 1
+
+        throughput = self.link.throughput
+        best, best_cost = (RAW, 0), nbytes / throughput
+        for choice, (ratio, speed) in entry[0].items():
+            # Data that barely compresses is never worth the CPU
+            if ratio > 0.9:
+                continue
+            cost = nbytes / speed + nbytes * ratio / throughput
+            if cost < best_cost:
+                best, best_cost = choice, cost
+        return best
+
+def make_codec(spec, link=None, peer_codecs=None):
+    # `peer_codecs` limits the auto codec to what the other side can decode
+    if spec == "auto":
+        allowed = set(available_codecs())
+        if peer_codecs is not None:
+            allowed &= set(peer_codecs)
+        return AutoCodec(link or LinkEstimator(), allowed)
+    return FixedCodec(*parse_codec(spec))
+
+def negotiate(offered, supported=None):
+    # Pick the first codec spec the peer offered that this side can handle
+    supported = set(supported or available_codecs()) | {"auto"}
+    for spec in offered:
+        if spec.partition(":")[0] in supported:
+            return spec
+    return "raw"
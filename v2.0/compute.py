@@ -0,0 +1,302 @@
+import os
+import queue
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import OUTPUT_KEYS, UNALIGNED_OUTPUTS, GLOBAL_OUTPUTS, PARTIAL_OUTPUTS, parse_level, process_image, required_halo
+from tiling import tiles_of_size, extract_tile, crop_halo
+
+# Outputs are packed into a worker's result arena at this alignment
+ALIGNMENT = 64
+# Side of the sub-blocks the block backend cuts tiles into; a 256x256 block of
+# 3-channel input plus its intermediates stays within a typical L2 cache
+BLOCK_SIZE = 256
+
+def default_workers():
+    return os.cpu_count() or 1
+
+def set_opencv_threads(cores, parallel):
+    # Give each of `parallel` concurrently running pipelines an equal share of
+    # the cores for OpenCV's own thread pool, so together they don't oversubscribe
+    threads = max(1, cores // max(1, parallel))
+    cv2.setNumThreads(threads)
+    return threads
+
+class ThreadBackend:
+    # Runs the pipeline directly on the calling thread. OpenCV releases the
+    # GIL inside its kernels, but the Python glue around them does not.
+    name = "thread"
+
+    def __init__(self, workers, cores=None):
+        self.workers = workers
+        self.opencv_threads = set_opencv_threads(cores or default_workers(), workers)
+
+    def run(self, image, on_output, outputs=None, core=None, op_times=None, op_spans=None):
+        process_image(image, outputs, on_output, core, op_times, op_spans)
+
+    def close(self):
+        pass
+
+def _aligned(size):
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+class _Arena:
+    # A shared memory block that is replaced by a bigger one when it runs out
+    def __init__(self):
+        self.shm = None
+
+    def ensure(self, size):
+        if self.shm is None or self.shm.size < size:
+            self.release()
+            self.shm = shared_memory.SharedMemory(create=True, size=max(_aligned(size), 1 << 20))
+        return self.shm
+
+    def release(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+def _attach(cache, name):
+    # Open a block created by the other process, closing the one it replaced
+    shm = cache.get("shm")
+    if shm is None or shm.name != name:
+        if shm is not None:
+            shm.close()
+        shm = cache["shm"] = shared_memory.SharedMemory(name=name)
+    return shm
+
+def _worker_main(conn, opencv_threads):
+    # Worker process loop. Tiles arrive in the parent's input block; each
+    # output is copied into this worker's result block and announced with a
+    # small message (offset, dtype, shape), so no array data is pickled. The
+    # seconds per op, and the ops' spans if the task is traced, come back with
+    # the message that ends the task.
+    # Offsets only reset when the next task arrives, by which time the parent
+    # has copied every output of the previous one.
+    cv2.setNumThreads(opencv_threads)
+    inputs = {}
+    results = _Arena()
+    retired = []
+    try:
+        while True:
+            message = conn.recv()
+            if message is None:
+                break
+            input_name, dtype, shape, outputs, core, traced = message
+            for arena in retired:
+                arena.release()
+            retired.clear()
+            state = {"offset": 0}
+
+            def emit(key, array):
+                offset = state["offset"]
+                if results.shm is None or offset + array.nbytes > results.shm.size:
+                    # Out of room: move to a bigger block, keeping the old one
+                    # mapped until the parent is done with this task
+                    if results.shm is not None:
+                        old = _Arena()
+                        old.shm = results.shm
+                        retired.append(old)
+                        results.shm = None
+                    results.ensure(max(array.nbytes, 2 * offset) * 2)
+                    offset = 0
+                view = np.ndarray(array.shape, dtype=array.dtype, buffer=results.shm.buf, offset=offset)
+                view[...] = array
+                del view
+                state["offset"] = offset + _aligned(array.nbytes)
+                conn.send(("output", key, results.shm.name, offset, array.dtype.str, array.shape))
+
+            try:
+                source = _attach(inputs, input_name)
+                image = np.ndarray(shape, dtype=dtype, buffer=source.buf)
+                op_times = {}
+                op_spans = [] if traced else None
+                process_image(image, outputs, emit, core, op_times, op_spans)
+                del image
+                conn.send(("done", op_times, op_spans))
+            except Exception as e:
+                conn.send(("error", f"{type(e).__name__}: {e}"))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        if "shm" in inputs:
+            inputs["shm"].close()
+        for arena in retired:
+            arena.release()
+        results.release()
+
+class _Worker:
+    def __init__(self, context, opencv_threads):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child, opencv_threads), daemon=True)
+        self.process.start()
+        child.close()
+        self.input = _Arena()
+        self.results = {}
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.input.release()
+        if "shm" in self.results:
+            self.results["shm"].close()
+
+class _WorkerDied(Exception):
+    # The pipe to a worker process broke: the worker is gone, not just the task
+    pass
+
+class ProcessBackend:
+    # Runs the pipeline in worker processes so the Python parts of it (and of
+    # the caller's encoding) don't serialize on one GIL. The tile is copied
+    # into shared memory once; each output comes back through the worker's
+    # shared result block and is copied out before being handed to on_output.
+    name = "process"
+
+    def __init__(self, workers, cores=None):
+        self.workers = workers
+        self.opencv_threads = max(1, (cores or default_workers()) // workers)
+        self.context = mp.get_context("spawn")
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.all = []
+        for _ in range(workers):
+            worker = _Worker(self.context, self.opencv_threads)
+            self.all.append(worker)
+            self.idle.put(worker)
+
+    def run(self, image, on_output, outputs=None, core=None, op_times=None, op_spans=None):
+        outputs = tuple(outputs) if outputs is not None else None
+        worker = self.idle.get()
+        try:
+            self._run_on(worker, image, on_output, outputs, core, op_times, op_spans)
+        except _WorkerDied:
+            # Replace the worker so the pool keeps its size. Failures of
+            # on_output (say, the client went away) propagate as they are.
+            worker.close()
+            with self.lock:
+                self.all.remove(worker)
+                worker = _Worker(self.context, self.opencv_threads)
+                self.all.append(worker)
+            raise RuntimeError("Compute worker process exited unexpectedly")
+        finally:
+            self.idle.put(worker)
+
+    def _run_on(self, worker, image, on_output, outputs, core, op_times, op_spans):
+        shm = worker.input.ensure(image.nbytes)
+        target = np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)
+        np.copyto(target, image)
+        del target
+        self._send(worker, (shm.name, image.dtype.str, image.shape, outputs, core, op_spans is not None))
+
+        # Keep reading until the worker finishes even if on_output fails, so
+        # the next task doesn't see this one's messages
+        failure = None
+        while True:
+            message = self._recv(worker)
+            if message[0] == "done":
+                if op_times is not None:
+                    for name, seconds in message[1].items():
+                        op_times[name] = op_times.get(name, 0.0) + seconds
+                if op_spans is not None:
+                    op_spans.extend(message[2])
+                break
+            if message[0] == "error":
+                failure = failure or RuntimeError(message[1])
+                break
+            _, key, name, offset, dtype, shape = message
+            result = _attach(worker.results, name)
+            array = np.ndarray(shape, dtype=dtype, buffer=result.buf, offset=offset).copy()
+            if failure is None:
+                try:
+                    on_output(key, array)
+                except Exception as e:
+                    failure = e
+        if failure is not None:
+            raise failure
+
+    def _send(self, worker, message):
+        try:
+            worker.conn.send(message)
+        except (EOFError, OSError) as e:
+            raise _WorkerDied() from e
+
+    def _recv(self, worker):
+        try:
+            return worker.conn.recv()
+        except (EOFError, OSError) as e:
+            raise _WorkerDied() from e
+
+    def close(self):
+        for worker in self.all:
+            worker.close()
+
+class BlockBackend:
+    # Splits each tile into cache-sized sub-blocks with halos and runs them on
+    # one pool with a thread per core, shared by every tile in flight. A lone
+    # large tile then uses all cores, and several tiles share them without
+    # oversubscribing, since OpenCV's own threading is turned off.
+    name = "blocks"
+
+    def __init__(self, workers, cores=None, block_size=BLOCK_SIZE):
+        self.workers = workers
+        self.cores = cores or default_workers()
+        self.block_size = block_size
+        self.opencv_threads = set_opencv_threads(self.cores, self.cores)
+        self.pool = ThreadPoolExecutor(max_workers=self.cores)
+
+    def run(self, image, on_output, outputs=None, core=None, op_times=None, op_spans=None):
+        outputs = tuple(OUTPUT_KEYS if outputs is None else outputs)
+        # Statistics and pyramid levels of the tile's core are taken over the tile as a whole too
+        local = tuple(key for key in outputs if key not in UNALIGNED_OUTPUTS and key not in GLOBAL_OUTPUTS and key not in PARTIAL_OUTPUTS
+                      and parse_level(key) is None)
+        whole = tuple(key for key in outputs if key not in local)
+        height, width = image.shape[:2]
+        blocks = tiles_of_size(height, width, self.block_size, self.block_size, required_halo(local)) if local else []
+        if len(blocks) <= 1:
+            process_image(image, outputs, on_output, core, op_times, op_spans)
+            return
+
+        # Op times are summed over blocks, so they are CPU seconds rather than
+        # wall time. Spans are appended from every block's thread.
+        block_times = [{} for _ in blocks] + [{}]
+        futures = [self.pool.submit(process_image, extract_tile(image, block), local, None, None, times, op_spans)
+                   for block, times in zip(blocks, block_times)]
+        whole_future = self.pool.submit(process_image, image, whole, None, core, block_times[-1], op_spans) if whole else None
+
+        # Crop each block's halo off and place it in the full-size output
+        results = {}
+        for block, future in zip(blocks, futures):
+            for key, part in future.result().items():
+                if key not in results:
+                    results[key] = np.empty((height, width) + part.shape[2:], dtype=part.dtype)
+                results[key][block.y0:block.y1, block.x0:block.x1] = crop_halo(part, block)
+        for key in local:
+            on_output(key, results.pop(key))
+        if whole_future is not None:
+            for key, value in whole_future.result().items():
+                on_output(key, value)
+        if op_times is not None:
+            for times in block_times:
+                for name, seconds in times.items():
+                    op_times[name] = op_times.get(name, 0.0) + seconds
+
+    def close(self):
+        self.pool.shutdown()
+
+def make_backend(name, workers, cores=None):
+    if name == "process":
+        return ProcessBackend(workers, cores)
+    if name == "blocks":
+        return BlockBackend(workers, cores)
+    if name == "thread":
+        return ThreadBackend(workers, cores)
+    raise ValueError(f"Unknown compute backend {name}")
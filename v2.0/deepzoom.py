@@ -0,0 +1,56 @@
+import os
+import math
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import halve
+
+# Deep Zoom layout: <name>.dzi describes the image and <name>_files/<level>/
+# holds the tiles of each level as <col>_<row>.<format>. Level 0 is 1x1 and
+# every level doubles the previous one up to full size. Tiles are TILE_SIZE
+# pixels plus OVERLAP pixels shared with each neighbour.
+TILE_SIZE = 254
+OVERLAP = 1
+FORMAT = "png"
+
+DZI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{format}" Overlap="{overlap}" TileSize="{tile_size}">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+"""
+
+def level_count(height, width):
+    return math.ceil(math.log2(max(height, width, 1))) + 1
+
+def complete_levels(levels):
+    # Extend `levels` (full size first, each one halved from the one before)
+    # down to 1x1
+    levels = list(levels)
+    while max(levels[-1].shape[:2]) > 1:
+        levels.append(halve(levels[-1]))
+    return levels
+
+def _write_tile(path, image, y0, y1, x0, x1):
+    if not cv2.imwrite(path, image[y0:y1, x0:x1]):
+        raise OSError(f"Failed to write {path}")
+
+def write_pyramid(base, levels, tile_size=TILE_SIZE, overlap=OVERLAP, format=FORMAT, workers=None):
+    # Writes `levels` (full size first, as from complete_levels) as <base>.dzi
+    # and <base>_files. Tiles are encoded and written on `workers` threads.
+    height, width = levels[0].shape[:2]
+    top = level_count(height, width) - 1
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        futures = []
+        for scale, image in enumerate(levels):
+            directory = os.path.join(f"{base}_files", str(top - scale))
+            os.makedirs(directory, exist_ok=True)
+            level_height, level_width = image.shape[:2]
+            for row in range(-(-level_height // tile_size)):
+                for col in range(-(-level_width // tile_size)):
+                    y0, x0 = max(0, row * tile_size - overlap), max(0, col * tile_size - overlap)
+                    y1, x1 = min(level_height, (row + 1) * tile_size + overlap), min(level_width, (col + 1) * tile_size + overlap)
+                    path = os.path.join(directory, f"{col}_{row}.{format}")
+                    futures.append(executor.submit(_write_tile, path, image, y0, y1, x0, x1))
+        for future in futures:
+            future.result()
+    with open(f"{base}.dzi", "w") as f:
+        f.write(DZI_TEMPLATE.format(format=format, overlap=overlap, tile_size=tile_size, width=width, height=height))
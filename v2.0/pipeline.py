@@ -0,0 +1,302 @@
+import cv2
+import time
+import threading
+import numpy as np
+from functools import lru_cache
+
+# Kernels are built once here instead of on every call to process_image
+SHARPEN_KERNEL = np.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])
+MORPH_KERNEL = np.ones((5, 5), np.uint8)
+
+# Part of every result cache key; bump it whenever an op's output changes so
+# results cached by an older pipeline are not served
+PIPELINE_VERSION = 2
+
+# Every output the pipeline can produce, in the order the client stores them
+OUTPUT_KEYS = [
+    "gray",
+    "blurred",
+    "edges",
+    "thresholded",
+    "equalized",
+    "resized",
+    "contrast_adjusted",
+    "brightness_adjusted",
+    "sharpened",
+    "hsv",
+    "lab",
+    "eroded",
+    "dilated",
+    "opened",
+    "closed",
+    "median_blurred",
+    "bilateral_filtered",
+    "corners"
+]
+
+# Outputs whose pixels do not line up with the input tile, so they cannot be
+# cropped back to the tile's core region after processing with a halo
+UNALIGNED_OUTPUTS = {"resized"}
+
+# Outputs that depend on statistics of the whole tile (its histogram, its
+# strongest corner response, edges connected anywhere in it), so they can't
+# be assembled from sub-blocks
+GLOBAL_OUTPUTS = {"equalized", "corners", "edges"}
+
+# Outputs of the whole image that a tiled run computes in two phases instead:
+# servers send what is listed here for each tile (partial statistics of its
+# core, or outputs to build on), the client combines them and finishes the
+# output for every tile (see reduction.py)
+TWO_PHASE_OUTPUTS = {
+    "equalized": ("gray_histogram", "gray"),
+    "corners": ("harris_peak", "corner_candidates"),
+    "resized": ("gray",),
+    "edges": ("edge_candidates",),
+}
+
+# Partial statistics of a tile's core rather than images
+PARTIAL_OUTPUTS = {"gray_histogram", "harris_peak", "corner_candidates"}
+
+# Inputs every op can use besides the outputs of other ops: "image" is the
+# source tile and "core" is (top, left, height, width) of the part of it the
+# tile stands for, without the ghost border
+SOURCES = ("image", "core")
+
+# Registry of ops: name -> (input names, function, halo). `halo` is how many
+# pixels beyond a location the op reads from its input.
+OPS = {}
+
+# Pyramid levels: "<output>@<level>" is the tile's core of <output> halved
+# `level` times, so the levels of a deep-zoom pyramid (deepzoom.py) come out
+# of the same pass. Their ops are registered the first time they are asked
+# for. Levels of neighbouring tiles only fit together if the tile cores are
+# aligned to 2 ** level pixels.
+def level_name(name, level):
+    return f"{name}@{level}"
+
+def parse_level(name):
+    # (output, level) of a pyramid level's name, or None for other outputs
+    base, sep, level = name.rpartition("@")
+    if sep and level.isdigit() and int(level) >= 1:
+        return base, int(level)
+    return None
+
+def op(name, *inputs, halo=0):
+    # Register a function as the op that produces `name` from `inputs`
+    def register(fn):
+        OPS[name] = (inputs, fn, halo)
+        return fn
+    return register
+
+@op("gray", "image")
+def gray_op(image):
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+@op("blurred", "gray", halo=2)
+def blurred_op(gray):
+    return cv2.GaussianBlur(gray, (5, 5), 0)
+
+CANNY_LOW = 100
+CANNY_HIGH = 200
+
+# The halo covers the Sobel gradient and non-maximum suppression, but not
+# hysteresis, which follows an edge any distance: tiled runs ask for
+# edge_candidates instead and finish the edges on the client (reduction.py)
+@op("edges", "blurred", halo=2)
+def edges_op(blurred):
+    return cv2.Canny(blurred, CANNY_LOW, CANNY_HIGH)
+
+# Canny before hysteresis: 1 where a pixel survives non-maximum suppression
+# above the low threshold, 2 where it is also above the high one. Canny with
+# both thresholds equal has nothing left for hysteresis to do, so it gives
+# exactly those pixels. Canny keeps the weak pixels 8-connected to a strong one.
+@op("edge_candidates", "blurred", halo=2)
+def edge_candidates_op(blurred):
+    candidates = cv2.Canny(blurred, CANNY_LOW, CANNY_LOW) // 255
+    candidates[cv2.Canny(blurred, CANNY_HIGH, CANNY_HIGH) > 0] = 2
+    return candidates
+
+@op("thresholded", "gray")
+def thresholded_op(gray):
+    _, thresholded = cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY)
+    return thresholded
+
+@op("equalized", "gray")
+def equalized_op(gray):
+    return cv2.equalizeHist(gray)
+
+@op("resized", "gray")
+def resized_op(gray):
+    return cv2.resize(gray, (128, 128))
+
+@op("contrast_adjusted", "gray")
+def contrast_adjusted_op(gray):
+    return cv2.convertScaleAbs(gray, alpha=1.5, beta=0)
+
+@op("brightness_adjusted", "gray")
+def brightness_adjusted_op(gray):
+    return cv2.convertScaleAbs(gray, alpha=1.0, beta=50)
+
+@op("sharpened", "gray", halo=1)
+def sharpened_op(gray):
+    return cv2.filter2D(gray, -1, SHARPEN_KERNEL)
+
+@op("hsv", "image")
+def hsv_op(image):
+    return cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+
+@op("lab", "image")
+def lab_op(image):
+    return cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
+
+@op("eroded", "gray", halo=2)
+def eroded_op(gray):
+    return cv2.erode(gray, MORPH_KERNEL, iterations=1)
+
+@op("dilated", "gray", halo=2)
+def dilated_op(gray):
+    return cv2.dilate(gray, MORPH_KERNEL, iterations=1)
+
+# Opening is dilate(erode(x)) and closing is erode(dilate(x)), so reuse the
+# eroded/dilated intermediates instead of running morphologyEx from scratch
+@op("opened", "eroded", halo=2)
+def opened_op(eroded):
+    return cv2.dilate(eroded, MORPH_KERNEL, iterations=1)
+
+@op("closed", "dilated", halo=2)
+def closed_op(dilated):
+    return cv2.erode(dilated, MORPH_KERNEL, iterations=1)
+
+@op("median_blurred", "gray", halo=2)
+def median_blurred_op(gray):
+    return cv2.medianBlur(gray, 5)
+
+@op("bilateral_filtered", "gray", halo=4)
+def bilateral_filtered_op(gray):
+    return cv2.bilateralFilter(gray, 9, 75, 75)
+
+@op("harris", "gray", halo=2)
+def harris_op(gray):
+    return cv2.cornerHarris(gray, 2, 3, 0.04)
+
+@op("corners", "image", "harris")
+def corners_op(image, harris):
+    corner_image = np.copy(image)
+    corner_image[harris > 0.01 * harris.max()] = [0, 0, 255]  # Mark corners in red
+    return corner_image
+
+def core_of(array, core):
+    top, left, height, width = core
+    return array[top:top + height, left:left + width]
+
+@op("gray_histogram", "gray", "core")
+def gray_histogram_op(gray, core):
+    return np.bincount(core_of(gray, core).ravel(), minlength=256)
+
+@op("harris_peak", "harris", "core")
+def harris_peak_op(harris, core):
+    return np.array([core_of(harris, core).max()], dtype=np.float32)
+
+# The whole image's corner threshold is 0.01 times its strongest response, so
+# it is at least 0.01 times this tile's: only pixels above that can be marked.
+# Returned as rows of (y, x, response) in core coordinates.
+@op("corner_candidates", "harris", "core")
+def corner_candidates_op(harris, core):
+    response = core_of(harris, core)
+    ys, xs = np.nonzero(response > 0.01 * response.max())
+    return np.column_stack([ys, xs, response[ys, xs]]).astype(np.float32)
+
+def halve(image):
+    # 2x2 box average; an odd last row or column is averaged with a copy of
+    # itself, so the result is ceil(height / 2) x ceil(width / 2)
+    height, width = image.shape[:2]
+    if height % 2 or width % 2:
+        image = cv2.copyMakeBorder(image, 0, height % 2, 0, width % 2, cv2.BORDER_REPLICATE)
+    return cv2.resize(image, (image.shape[1] // 2, image.shape[0] // 2), interpolation=cv2.INTER_AREA)
+
+def get_op(name):
+    # The registered op for `name`, registering pyramid levels on first use
+    if name not in OPS:
+        parsed = parse_level(name)
+        if parsed is None:
+            raise KeyError(f"Unknown pipeline output: {name}")
+        base, level = parsed
+        if level == 1:
+            def first_level_op(image, core):
+                return halve(core_of(image, core))
+            OPS[name] = ((base, "core"), first_level_op, 0)
+        else:
+            OPS[name] = ((level_name(base, level - 1),), halve, 0)
+    return OPS[name]
+
+@lru_cache(maxsize=None)
+def build_plan(outputs, streaming=False):
+    # Order the ops needed for `outputs` so every input is computed before use.
+    # When streaming, outputs are handed off as they are produced, so they can
+    # be dropped after their last use like any other intermediate.
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name in SOURCES or name in order:
+            return
+        if name in visiting:
+            raise ValueError(f"Cycle in pipeline at {name}")
+        visiting.add(name)
+        for dep in get_op(name)[0]:
+            visit(dep)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in outputs:
+        visit(name)
+
+    # Record after which step each intermediate can be dropped
+    last_use = {}
+    for step, name in enumerate(order):
+        last_use.setdefault(name, step)
+        for dep in get_op(name)[0]:
+            last_use[dep] = step
+    releases = [[] for _ in order]
+    for name, step in last_use.items():
+        if name not in SOURCES and (streaming or name not in outputs):
+            releases[step].append(name)
+
+    return tuple((name, *get_op(name)[:2], tuple(releases[step])) for step, name in enumerate(order))
+
+@lru_cache(maxsize=None)
+def required_halo(outputs):
+    # Widest ghost border any of `outputs` needs so that pixels in a tile's core
+    # match what processing the whole image would give (ops chain their halos)
+    def reach(name):
+        if name in SOURCES:
+            return 0
+        inputs, _, halo = get_op(name)
+        return halo + max(reach(dep) for dep in inputs)
+
+    return max((reach(name) for name in outputs if name not in UNALIGNED_OUTPUTS), default=0)
+
+def process_image(image, outputs=None, on_output=None, core=None, op_times=None, op_spans=None):
+    # Run only the ops needed for the requested outputs (all of them by default).
+    # With `on_output`, each output is passed to on_output(name, array) as soon
+    # as it is computed instead of being collected into the returned dict.
+    # `core` is the tile's own region of `image` (the whole image by default).
+    # With `op_times`, the seconds each op took are added to it by name, and
+    # with `op_spans` each op is appended to it as a tracing span.
+    outputs = tuple(OUTPUT_KEYS if outputs is None else outputs)
+    values = {"image": image, "core": tuple(core) if core is not None else (0, 0) + image.shape[:2]}
+    for name, inputs, fn, releases in build_plan(outputs, on_output is not None):
+        start = time.time() if op_spans is not None else None
+        started = time.perf_counter()
+        values[name] = fn(*(values[dep] for dep in inputs))
+        seconds = time.perf_counter() - started
+        if op_times is not None:
+            op_times[name] = op_times.get(name, 0.0) + seconds
+        if op_spans is not None:
+            op_spans.append((name, start, seconds, threading.get_native_id()))
+        if on_output is not None and name in outputs:
+            on_output(name, values[name])
+        for dep in releases:
+            del values[dep]
+    if on_output is None:
+        return {name: values[name] for name in outputs}
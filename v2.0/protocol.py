@@ -0,0 +1,201 @@
+import time
+import json
+import struct
+import asyncio
+import threading
+import numpy as np
+from codec import FixedCodec, encode_array, decode_array
+
+# Every message on a connection is a frame: kind (1 byte), request id (8 bytes)
+# and payload length (8 bytes), all big-endian, followed by the payload. The
+# request id lets many tiles be in flight on one socket and answered in any order.
+FRAME_HEADER = struct.Struct("!BQQ")
+
+# Frame kinds
+REQUEST = 1   # client -> server: an encoded tile
+RESPONSE = 2  # server -> client: the request is complete; payload is the server's JSON timings, or empty
+ERROR = 3     # server -> client: the request failed; payload is a UTF-8 message
+HELLO = 4     # both ways, once per connection: JSON codec offer and answer
+OUTPUT = 5    # server -> client: one processed output, sent as soon as it is ready
+HEARTBEAT = 6 # server -> registry: JSON load report, repeated every second or so
+LOOKUP = 7    # client <-> registry: JSON query, answered with the live servers
+
+# Tiles and results travel as a set of named arrays. The payload starts with
+# the array count, then for each array a fixed header (name length, ndim,
+# dtype string, codec, encoded size), the name, the shape, and the encoded
+# bytes. Raw arrays are read back as views into the received buffer.
+ARRAY_COUNT = struct.Struct("!H")
+ARRAY_HEADER = struct.Struct("!BB8sBQ")
+ARRAY_DIM = struct.Struct("!I")
+
+class RemoteError(Exception):
+    # Raised on the client when the server answers a request with an ERROR frame
+    pass
+
+def recv_exact(conn, size):
+    # Read exactly `size` bytes into one preallocated buffer
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = conn.recv_into(view[received:], size - received)
+        if not count:
+            raise EOFError("Connection closed by peer")
+        received += count
+    return buffer
+
+def send_buffers(conn, buffers):
+    # Scatter-gather write of every buffer without joining them into one string
+    views = [memoryview(buffer).cast("B") for buffer in buffers]
+    views = [view for view in views if len(view)]
+    if not hasattr(conn, "sendmsg"):
+        for view in views:
+            conn.sendall(view)
+        return
+    while views:
+        sent = conn.sendmsg(views[:64])
+        # Drop fully sent buffers and trim the partially sent one
+        while sent and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if sent:
+            views[0] = views[0][sent:]
+
+def send_frame(conn, kind, request_id, *buffers):
+    size = sum(memoryview(buffer).nbytes for buffer in buffers)
+    send_buffers(conn, [FRAME_HEADER.pack(kind, request_id, size)] + list(buffers))
+
+def recv_frame(conn, link=None):
+    # Returns (kind, request_id, payload), or None if the peer closed the
+    # connection cleanly between frames. If `link` is given, the time taken
+    # to receive the payload is recorded on it as a throughput sample.
+    first = conn.recv(FRAME_HEADER.size)
+    if not first:
+        return None
+    header = first if len(first) == FRAME_HEADER.size else first + recv_exact(conn, FRAME_HEADER.size - len(first))
+    kind, request_id, size = FRAME_HEADER.unpack(header)
+    started = time.perf_counter()
+    payload = recv_exact(conn, size) if size else bytearray()
+    if link is not None:
+        link.record(size, time.perf_counter() - started)
+    return kind, request_id, payload
+
+def send_json(conn, kind, request_id, message):
+    send_frame(conn, kind, request_id, json.dumps(message).encode("utf-8"))
+
+def load_json(payload):
+    return json.loads(bytes(payload).decode("utf-8"))
+
+def encode_arrays(arrays, codec=None):
+    # Returns the list of buffers making up the payload, for send_frame.
+    # `codec` (from codec.make_codec) picks the encoding of each array.
+    codec = codec or FixedCodec("raw", 0)
+    buffers = [ARRAY_COUNT.pack(len(arrays))]
+    for name, array in arrays.items():
+        used, data = encode_array(array, *codec.choose(name, array))
+        name_bytes = name.encode("utf-8")
+        buffers.append(ARRAY_HEADER.pack(len(name_bytes), array.ndim, array.dtype.str.encode("ascii"), used, memoryview(data).nbytes))
+        buffers.append(name_bytes + b"".join(ARRAY_DIM.pack(dim) for dim in array.shape))
+        buffers.append(data)
+    return buffers
+
+def array_entries(view):
+    # Yields (name, dtype, shape, codec, data) for each array in a payload
+    # without decoding any of them
+    (count,) = ARRAY_COUNT.unpack_from(view, 0)
+    offset = ARRAY_COUNT.size
+    for _ in range(count):
+        name_length, ndim, dtype, codec, size = ARRAY_HEADER.unpack_from(view, offset)
+        offset += ARRAY_HEADER.size
+        name = bytes(view[offset:offset + name_length]).decode("utf-8")
+        offset += name_length
+        shape = tuple(ARRAY_DIM.unpack_from(view, offset + i * ARRAY_DIM.size)[0] for i in range(ndim))
+        offset += ndim * ARRAY_DIM.size
+        yield name, np.dtype(dtype.rstrip(b"\0").decode("ascii")), shape, codec, view[offset:offset + size]
+        offset += size
+
+def decode_arrays(payload, names=None):
+    # Decode every array, or only those in `names`
+    return {name: decode_array(data, dtype, shape, codec) for name, dtype, shape, codec, data in array_entries(memoryview(payload))
+            if names is None or name in names}
+
+def array_shapes(payload):
+    # Shapes of the arrays in a payload, read from the headers alone
+    return {name: shape for name, _, shape, _, _ in array_entries(memoryview(payload))}
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    # asyncio side of the framing: the event loop reads each frame header and
+    # then the payload straight into a preallocated buffer, and calls
+    # frame_received(kind, request_id, payload) once a frame is complete;
+    # during that call receive_seconds is how long the payload took to arrive.
+    # send() may be called from any thread; it blocks while the peer is not
+    # keeping up so senders can't queue unbounded data.
+    def __init__(self, link=None):
+        self.link = link
+        self.transport = None
+        self.closed = False
+        self.writable = threading.Event()
+        self.writable.set()
+        self.receive_seconds = 0.0
+        self._header = bytearray(FRAME_HEADER.size)
+        self._expect_header()
+
+    def _expect_header(self):
+        self._frame = None
+        self._buffer = memoryview(self._header)
+        self._filled = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+
+    def get_buffer(self, sizehint):
+        return self._buffer[self._filled:]
+
+    def buffer_updated(self, nbytes):
+        self._filled += nbytes
+        if self._filled < len(self._buffer):
+            return
+        if self._frame is None:
+            kind, request_id, size = FRAME_HEADER.unpack(self._header)
+            self._frame = (kind, request_id, time.perf_counter())
+            payload = bytearray(size)
+            if size:
+                self._buffer = memoryview(payload)
+                self._filled = 0
+                self._payload = payload
+                return
+            self._payload = payload
+        kind, request_id, started = self._frame
+        payload = self._payload
+        self.receive_seconds = time.perf_counter() - started
+        if self.link is not None:
+            self.link.record(len(payload), self.receive_seconds)
+        self._payload = None
+        self._expect_header()
+        self.frame_received(kind, request_id, payload)
+
+    def frame_received(self, kind, request_id, payload):
+        raise NotImplementedError
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.writable.set()
+
+    def write_frame(self, kind, request_id, *buffers):
+        # Event loop thread only
+        size = sum(memoryview(buffer).nbytes for buffer in buffers)
+        self.transport.writelines([FRAME_HEADER.pack(kind, request_id, size)] + [memoryview(buffer).cast("B") for buffer in buffers])
+
+    def send(self, kind, request_id, *buffers):
+        # Any thread: wait out backpressure, then queue the whole frame on the loop
+        self.writable.wait()
+        if self.closed:
+            raise ConnectionError("Connection closed by peer")
+        self.loop.call_soon_threadsafe(self.write_frame, kind, request_id, *buffers)
@@ -0,0 +1,229 @@
+import zlib
+import struct
+import threading
+import numpy as np
+from collections import OrderedDict
+from PIL import Image
+
+# Baseline TIFF tags the streaming reader understands
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIGURATION = 284
+PREDICTOR = 317
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+SAMPLE_FORMAT = 339
+
+# Field type -> struct format of one value
+FIELD_TYPES = {1: "B", 2: "B", 3: "H", 4: "I", 6: "b", 7: "B", 8: "h", 9: "i", 16: "Q", 17: "q"}
+
+# Compression schemes decoded chunk by chunk; anything else is loaded whole
+UNCOMPRESSED = 1
+DEFLATE = (8, 32946)
+
+# Decoded strips or tiles kept for neighbouring reads
+CHUNK_CACHE = 16
+
+class NotStreamable(Exception):
+    # The TIFF's layout or compression needs the whole image decoded at once
+    pass
+
+def load_image(path):
+    # Load the image using Pillow
+    with Image.open(path) as source:
+        return np.array(source.convert('RGB'))  # Convert to RGB if necessary, then to a NumPy array
+
+class ArrayRaster:
+    # An image that is already in memory
+    def __init__(self, image):
+        self.image = image
+        self.shape = image.shape
+
+    def read(self, y0, y1, x0, x1):
+        return self.image[y0:y1, x0:x1]
+
+    def close(self):
+        pass
+
+class TiffRaster:
+    # Reads regions of an 8-bit RGB, RGBA or grayscale TIFF on demand, as RGB,
+    # without decoding the rest of the image. Uncompressed images stored in
+    # one contiguous run are memory-mapped, so a read is a view of the page
+    # cache; other uncompressed or Deflate images are decoded one strip or
+    # tile at a time, keeping the last few decoded in a small cache.
+    def __init__(self, path, cache_chunks=CHUNK_CACHE):
+        self.path = path
+        self.file = open(path, "rb")
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.decoding = {}
+        self.cache_chunks = cache_chunks
+        self.array = None
+        try:
+            self._parse()
+        except Exception:
+            self.file.close()
+            raise
+
+    def _unpack(self, fmt, data, offset=0):
+        return struct.unpack_from(self.order + fmt, data, offset)
+
+    def _parse(self):
+        header = self.file.read(16)
+        if header[:2] not in (b"II", b"MM"):
+            raise NotStreamable("not a TIFF file")
+        self.order = "<" if header[:2] == b"II" else ">"
+        (version,) = self._unpack("H", header, 2)
+        if version == 42:
+            self.big = False
+            (offset,) = self._unpack("I", header, 4)
+        elif version == 43:
+            self.big = True
+            (offset,) = self._unpack("Q", header, 8)
+        else:
+            raise NotStreamable(f"unknown TIFF version {version}")
+        tags = self._read_ifd(offset)
+
+        def tag(code, default=None):
+            values = tags.get(code)
+            if values is None:
+                if default is None:
+                    raise NotStreamable(f"missing TIFF tag {code}")
+                return default
+            return values
+
+        width, height = tag(IMAGE_WIDTH)[0], tag(IMAGE_LENGTH)[0]
+        self.samples = tag(SAMPLES_PER_PIXEL, (1,))[0]
+        bits = tag(BITS_PER_SAMPLE, (1,) * self.samples)
+        self.compression = tag(COMPRESSION, (1,))[0]
+        self.predictor = tag(PREDICTOR, (1,))[0]
+        photometric = tag(PHOTOMETRIC)[0]
+        if any(b != 8 for b in bits) or tag(SAMPLE_FORMAT, (1,))[0] != 1:
+            raise NotStreamable("only 8-bit unsigned samples are streamed")
+        if not ((photometric == 1 and self.samples in (1, 2)) or (photometric == 2 and self.samples in (3, 4))):
+            raise NotStreamable(f"photometric interpretation {photometric} with {self.samples} samples")
+        if self.samples > 1 and tag(PLANAR_CONFIGURATION, (1,))[0] != 1:
+            raise NotStreamable("planar sample layout")
+        if self.compression != UNCOMPRESSED and self.compression not in DEFLATE:
+            raise NotStreamable(f"compression {self.compression}")
+        if self.predictor not in (1, 2):
+            raise NotStreamable(f"predictor {self.predictor}")
+
+        self.shape = (height, width, 3)
+        if TILE_OFFSETS in tags:
+            self.chunk_height, self.chunk_width = tag(TILE_LENGTH)[0], tag(TILE_WIDTH)[0]
+            self.offsets, self.byte_counts = tag(TILE_OFFSETS), tag(TILE_BYTE_COUNTS)
+        else:
+            self.chunk_height, self.chunk_width = min(tag(ROWS_PER_STRIP, (height,))[0], height), width
+            self.offsets, self.byte_counts = tag(STRIP_OFFSETS), tag(STRIP_BYTE_COUNTS)
+        self.chunks_across = -(-width // self.chunk_width)
+
+        # Uncompressed strips that follow each other in the file are one
+        # (height, width, samples) array on disk
+        if self.compression == UNCOMPRESSED and TILE_OFFSETS not in tags:
+            contiguous = all(self.offsets[i] + self.byte_counts[i] == self.offsets[i + 1] for i in range(len(self.offsets) - 1))
+            if contiguous and sum(self.byte_counts) >= height * width * self.samples:
+                self.array = np.memmap(self.path, dtype=np.uint8, mode="r", offset=self.offsets[0],
+                                       shape=(height, width, self.samples))
+
+    def _read_ifd(self, offset):
+        count_format, entry_size, inline = ("Q", 20, 8) if self.big else ("H", 12, 4)
+        self.file.seek(offset)
+        (count,) = self._unpack(count_format, self.file.read(8 if self.big else 2))
+        entries = self.file.read(count * entry_size)
+        tags = {}
+        for i in range(count):
+            entry = i * entry_size
+            code, field_type = self._unpack("HH", entries, entry)
+            (length,) = self._unpack("Q" if self.big else "I", entries, entry + 4)
+            fmt = FIELD_TYPES.get(field_type)
+            if fmt is None:
+                continue
+            size = struct.calcsize(fmt) * length
+            value_at = entry + 4 + inline
+            if size <= inline:
+                data = entries[value_at:value_at + size]
+            else:
+                (pointer,) = self._unpack("Q" if self.big else "I", entries, value_at)
+                position = self.file.tell()
+                self.file.seek(pointer)
+                data = self.file.read(size)
+                self.file.seek(position)
+            tags[code] = self._unpack(f"{length}{fmt}", data)
+        return tags
+
+    def _chunk(self, index):
+        # One decoded strip or tile as a (rows, chunk_width, samples) array.
+        # A thread that wants a chunk another thread is decoding waits for it
+        # instead of decoding it again.
+        while True:
+            with self.lock:
+                chunk = self.cache.get(index)
+                if chunk is not None:
+                    self.cache.move_to_end(index)
+                    return chunk
+                decoding = self.decoding.get(index)
+                if decoding is None:
+                    decoding = self.decoding[index] = threading.Event()
+                    self.file.seek(self.offsets[index])
+                    data = self.file.read(self.byte_counts[index])
+                    break
+            decoding.wait()
+        try:
+            if self.compression in DEFLATE:
+                data = zlib.decompress(data)
+            rows = len(data) // (self.chunk_width * self.samples)
+            chunk = np.frombuffer(data, dtype=np.uint8)[:rows * self.chunk_width * self.samples].reshape(rows, self.chunk_width, self.samples)
+            if self.predictor == 2:
+                # Undo horizontal differencing; uint8 sums wrap around like the encoder's
+                chunk = np.cumsum(chunk, axis=1, dtype=np.uint8)
+            with self.lock:
+                self.cache[index] = chunk
+                if len(self.cache) > self.cache_chunks:
+                    self.cache.popitem(last=False)
+            return chunk
+        finally:
+            with self.lock:
+                del self.decoding[index]
+            decoding.set()
+
+    def read(self, y0, y1, x0, x1):
+        if self.array is not None:
+            region = self.array[y0:y1, x0:x1]
+        else:
+            region = np.empty((y1 - y0, x1 - x0, self.samples), dtype=np.uint8)
+            for row in range(y0 // self.chunk_height, -(-y1 // self.chunk_height)):
+                for col in range(x0 // self.chunk_width, -(-x1 // self.chunk_width)):
+                    chunk = self._chunk(row * self.chunks_across + col)
+                    top, left = row * self.chunk_height, col * self.chunk_width
+                    cy0, cy1 = max(y0, top), min(y1, top + chunk.shape[0])
+                    cx0, cx1 = max(x0, left), min(x1, left + self.chunk_width)
+                    region[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0] = chunk[cy0 - top:cy1 - top, cx0 - left:cx1 - left]
+        # Same pixels as Pillow's convert('RGB'): drop alpha, spread gray over three channels
+        if self.samples in (1, 2):
+            return np.repeat(region[:, :, :1], 3, axis=2)
+        return region[:, :, :3]
+
+    def close(self):
+        self.array = None
+        self.file.close()
+
+def open_raster(path):
+    # Stream the image if its layout allows it, otherwise load it whole
+    if path.lower().endswith((".tif", ".tiff")):
+        try:
+            raster = TiffRaster(path)
+            print(f"Streaming {path} ({'memory-mapped' if raster.array is not None else 'decoded per strip or tile'})")
+            return raster
+        except NotStreamable as e:
+            print(f"Loading {path} whole: {e}")
+    return ArrayRaster(load_image(path))
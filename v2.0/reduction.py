@@ -0,0 +1,154 @@
+import cv2
+import numpy as np
+from pipeline import TWO_PHASE_OUTPUTS, resized_op
+
+# Second phase of the outputs in pipeline.TWO_PHASE_OUTPUTS. Servers only see
+# their own tile, so for those outputs they send partial statistics of it
+# instead; once every tile is in, the client reduces them to the whole
+# image's statistics and finishes the output tile by tile. The result is the
+# same as processing the whole image at once.
+
+# Registry of finishing steps: output name -> function(tiles, partials,
+# canvases, raster) that fills canvases[name]. `partials` maps each partial
+# output to its value per tile, `canvases` holds the assembled outputs and
+# the intermediate images servers sent for them.
+FINISHERS = {}
+
+# Outputs finished on the source image: the client places each tile's core
+# on their canvas, as BGR, when it reads the tile to send it
+SOURCE_OUTPUTS = ("corners",)
+
+def finisher(name):
+    def register(fn):
+        FINISHERS[name] = fn
+        return fn
+    return register
+
+def tiled_outputs(outputs):
+    # What servers are asked for when the image is split into tiles: the
+    # outputs themselves, with each two-phase one replaced by what it needs
+    requested = []
+    for name in outputs:
+        for needed in TWO_PHASE_OUTPUTS.get(name, (name,)):
+            if needed not in requested:
+                requested.append(needed)
+    return tuple(requested)
+
+def finish_outputs(outputs, tiles, partials, canvases, raster):
+    for name in outputs:
+        if name in FINISHERS:
+            FINISHERS[name](tiles, partials, canvases, raster)
+
+def equalization_lut(histogram):
+    # The lookup table cv2.equalizeHist builds from an image's histogram,
+    # including its float32 scaling and rounding, so the result is identical
+    first = int(np.flatnonzero(histogram)[0])
+    total = int(histogram.sum())
+    if histogram[first] == total:
+        return np.full(256, first, dtype=np.uint8)
+    scale = np.float32(255) / np.float32(total - histogram[first])
+    counts = np.cumsum(histogram) - histogram[first]
+    lut = np.clip(np.rint(counts.astype(np.float32) * scale), 0, 255).astype(np.uint8)
+    lut[:first] = 0
+    return lut
+
+@finisher("equalized")
+def finish_equalized(tiles, partials, canvases, raster):
+    # Reduce: the image's histogram is the sum of its tiles'. Then map every
+    # tile's gray pixels through the one lookup table.
+    lut = equalization_lut(np.sum(partials["gray_histogram"], axis=0))
+    gray = canvases["gray"].array
+    for tile in tiles:
+        canvases["equalized"].place(tile, lut[gray[tile.y0:tile.y1, tile.x0:tile.x1]])
+
+@finisher("corners")
+def finish_corners(tiles, partials, canvases, raster):
+    # Reduce: the image's strongest Harris response is the largest of its
+    # tiles'. Then mark the candidates above the image's threshold in place
+    # on the source image already on the canvas (SOURCE_OUTPUTS).
+    threshold = 0.01 * np.concatenate(partials["harris_peak"]).max()
+    for tile, candidates in zip(tiles, partials["corner_candidates"]):
+        marked = candidates[candidates[:, 2] > threshold]
+        canvases["corners"].region(tile)[marked[:, 0].astype(np.intp), marked[:, 1].astype(np.intp)] = [0, 0, 255]
+
+@finisher("resized")
+def finish_resized(tiles, partials, canvases, raster):
+    # Resizing only samples the pixels around each output pixel, so run the op
+    # on the assembled gray image; the result is small and replaces the canvas
+    canvases["resized"].array = resized_op(canvases["gray"].array)
+
+def tile_components(candidates, tile, offset):
+    # 8-connected groups of a tile's edge candidates, numbered from offset + 1
+    # (0 where there are none)
+    part = candidates.region(tile)
+    count, labels = cv2.connectedComponents((part > 0).view(np.uint8), connectivity=8)
+    labels = labels.astype(np.int64)
+    labels[labels > 0] += offset
+    return count - 1, labels, part
+
+def seam_pairs(before, after):
+    # Labels that touch across seams, given the labels of the pixel lines on
+    # either side of each seam: 8-connectivity joins a pixel to the three
+    # facing it
+    width = before.shape[1]
+    pairs = [np.empty((0, 2), dtype=np.int64)]
+    for shift in (-1, 0, 1):
+        facing = before[:, max(0, -shift):width - max(0, shift)]
+        across = after[:, max(0, shift):width - max(0, -shift)]
+        touching = (facing > 0) & (across > 0)
+        pairs.append(np.stack([facing[touching], across[touching]], axis=1))
+    return np.concatenate(pairs)
+
+def find(parent, label):
+    while parent[label] != label:
+        parent[label] = parent[parent[label]]
+        label = parent[label]
+    return label
+
+@finisher("edges")
+def finish_edges(tiles, partials, canvases, raster):
+    # Hysteresis over the whole image, so edges carry on across tile seams:
+    # keep every 8-connected group of candidates that has a strong pixel in
+    # it. Groups are labelled tile by tile and joined where they meet across
+    # a seam, so only one tile's labels and the lines along the seams are in
+    # memory at once.
+    candidates = canvases["edge_candidates"]
+    height, width = candidates.array.shape[:2]
+    seam_rows = {y: i for i, y in enumerate(sorted({tile.y0 for tile in tiles if tile.y0 > 0}))}
+    seam_cols = {x: i for i, x in enumerate(sorted({tile.x0 for tile in tiles if tile.x0 > 0}))}
+    above, below = np.zeros((2, len(seam_rows), width), dtype=np.int64)
+    left, right = np.zeros((2, len(seam_cols), height), dtype=np.int64)
+    offsets, strong = [], []
+    total = 0
+    for tile in tiles:
+        count, labels, part = tile_components(candidates, tile, total)
+        offsets.append(total)
+        total += count
+        strong.append(np.unique(labels[part == 2]))
+        if tile.y0 in seam_rows:
+            below[seam_rows[tile.y0], tile.x0:tile.x1] = labels[0]
+        if tile.y1 in seam_rows:
+            above[seam_rows[tile.y1], tile.x0:tile.x1] = labels[-1]
+        if tile.x0 in seam_cols:
+            right[seam_cols[tile.x0], tile.y0:tile.y1] = labels[:, 0]
+        if tile.x1 in seam_cols:
+            left[seam_cols[tile.x1], tile.y0:tile.y1] = labels[:, -1]
+
+    # Join groups across seams (union-find) and keep the groups that reach a
+    # strong pixel in any tile
+    pairs = np.unique(np.concatenate([seam_pairs(above, below), seam_pairs(left, right)]), axis=0)
+    parent = list(range(total + 1))
+    for a, b in pairs.tolist():
+        a, b = find(parent, a), find(parent, b)
+        if a != b:
+            parent[a] = b
+    keep = np.zeros(total + 1, dtype=bool)
+    keep[np.concatenate(strong)] = True
+    strong_roots = {find(parent, label) for label in np.flatnonzero(keep).tolist()}
+    for label in np.unique(pairs).tolist():
+        keep[label] = find(parent, label) in strong_roots
+
+    # Label each tile again, the same way, and draw the kept groups
+    for tile, offset in zip(tiles, offsets):
+        _, labels, _ = tile_components(candidates, tile, offset)
+        canvases["edges"].place(tile, keep[labels].astype(np.uint8) * 255)
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import socket
+import argparse
+import asyncio
+import threading
+from protocol import HEARTBEAT, LOOKUP, FrameProtocol, send_json, recv_frame, load_json
+
+# Servers report their load to the registry every HEARTBEAT_INTERVAL seconds
+# and are dropped once nothing has been heard from them for HEARTBEAT_TIMEOUT
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_TIMEOUT = 3.5
+DEFAULT_PORT = 65431
+
+def parse_address(text, default_port=DEFAULT_PORT):
+    # "host:port" or "host" -> (host, port)
+    host, _, port = text.rpartition(":")
+    if not host:
+        return text, default_port
+    return host, int(port)
+
+class Registry:
+    # Latest load report of every live server process, keyed by node id.
+    # Several listener processes can share one address (SO_REUSEPORT); they
+    # register separately and are added up when clients look servers up.
+    def __init__(self, timeout=HEARTBEAT_TIMEOUT):
+        self.timeout = timeout
+        self.nodes = {}
+
+    def update(self, report):
+        if report["node"] not in self.nodes:
+            host, port = report["address"]
+            print(f"Registered {report['node']} serving {host}:{port} with {report['workers']} compute workers")
+        self.nodes[report["node"]] = (time.monotonic(), report)
+
+    def remove(self, node):
+        if self.nodes.pop(node, None) is not None:
+            print(f"Unregistered {node}")
+
+    def live(self):
+        now = time.monotonic()
+        for node, (seen, _) in list(self.nodes.items()):
+            if now - seen > self.timeout:
+                print(f"{node} missed its heartbeats")
+                self.remove(node)
+        return [report for _, report in self.nodes.values()]
+
+    def lookup(self, count=None):
+        # Live servers, least loaded first. Load is the time the work already
+        # queued or running on a server should take at its measured pixel
+        # throughput; idle servers are ordered fastest first.
+        servers = {}
+        for report in self.live():
+            address = tuple(report["address"])
+            entry = servers.setdefault(address, {"address": list(address), "queued": 0, "in_flight": 0,
+                                                 "pending_pixels": 0, "workers": 0, "pixels_per_second": 0.0})
+            for key in ("queued", "in_flight", "pending_pixels", "workers"):
+                entry[key] += report[key]
+            entry["pixels_per_second"] += report["pixels_per_second"] * report["workers"]
+            # Seconds each listener has spent per processing stage so far
+            stage_seconds = entry.setdefault("stage_seconds", {})
+            for stage, seconds in report.get("stage_seconds", {}).items():
+                stage_seconds[stage] = stage_seconds.get(stage, 0.0) + seconds
+
+        # Servers that haven't processed anything yet are assumed to be as fast as the average
+        measured = [entry["pixels_per_second"] for entry in servers.values() if entry["pixels_per_second"] > 0]
+        average = sum(measured) / len(measured) if measured else 1.0
+        for entry in servers.values():
+            entry["load"] = entry["pending_pixels"] / (entry["pixels_per_second"] or average)
+        ranked = sorted(servers.values(), key=lambda entry: (entry["load"], -entry["pixels_per_second"]))
+        return ranked if count is None else ranked[:count]
+
+class RegistryConnection(FrameProtocol):
+    # A server sending heartbeats, or a client looking servers up. The nodes a
+    # connection registered are dropped as soon as it closes, so a server that
+    # dies is forgotten without waiting for its heartbeats to time out.
+    def __init__(self, registry):
+        super().__init__()
+        self.registry = registry
+        self.nodes = set()
+
+    def frame_received(self, kind, request_id, payload):
+        message = load_json(payload)
+        if kind == HEARTBEAT:
+            self.nodes.add(message["node"])
+            self.registry.update(message)
+        elif kind == LOOKUP:
+            answer = {"servers": self.registry.lookup(message.get("count"))}
+            self.write_frame(LOOKUP, request_id, json.dumps(answer).encode("utf-8"))
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        for node in self.nodes:
+            self.registry.remove(node)
+
+async def serve(host, port, timeout):
+    loop = asyncio.get_running_loop()
+    registry = Registry(timeout)
+    server = await loop.create_server(lambda: RegistryConnection(registry), host, port)
+    print(f"Registry listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+class Heartbeat:
+    # Keeps a server registered: a background thread sends report() to the
+    # registry every `interval` seconds, reconnecting whenever the registry
+    # has gone away
+    def __init__(self, registry, report, interval=HEARTBEAT_INTERVAL):
+        self.registry = registry
+        self.report = report
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        conn = None
+        reachable = True
+        while not self.stopped.is_set():
+            try:
+                if conn is None:
+                    conn = socket.create_connection(self.registry, timeout=5)
+                send_json(conn, HEARTBEAT, 0, self.report())
+                reachable = True
+            except OSError as e:
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                if reachable:
+                    print(f"Registry {self.registry[0]}:{self.registry[1]} unreachable: {e}")
+                reachable = False
+            self.stopped.wait(self.interval)
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+def node_id():
+    return f"{socket.gethostname()}/{os.getpid()}"
+
+def lookup_servers(registry, count=None, timeout=5):
+    # Ask the registry for up to `count` live servers, least loaded first.
+    # Returns their load reports; each has an "address" of [host, port].
+    with socket.create_connection(registry, timeout=timeout) as conn:
+        send_json(conn, LOOKUP, 0, {"count": count})
+        frame = recv_frame(conn)
+    if frame is None:
+        raise ConnectionError("Registry closed the connection")
+    return load_json(frame[2])["servers"]
+
+if __name__ == "__main__":
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description="Registry that tracks live image processing servers and their load")
+    parser.add_argument("--host", default=env("REGISTRY_HOST", "127.0.0.1"), help="address to listen on")
+    parser.add_argument("--port", type=int, default=int(env("REGISTRY_PORT", DEFAULT_PORT)))
+    parser.add_argument("--timeout", type=float, default=float(env("REGISTRY_TIMEOUT", HEARTBEAT_TIMEOUT)),
+                        help="seconds without a heartbeat before a server is considered dead")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.timeout))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,67 @@
+import math
+import bisect
+import hashlib
+
+# Points each server gets on the hash ring; more points spread tiles more evenly
+REPLICAS = 128
+# Bounded loads: no server is assigned more than (1 + LOAD_EPSILON) times the
+# average number of tiles, whatever their keys hash to
+LOAD_EPSILON = 0.25
+
+def _point(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+def position_key(tile):
+    # Key of a tile by its place in the image (a tiling.Tile). Tiles are routed
+    # by where they are rather than by what they hold: a tile is only read
+    # when a server pulls it, after routing has been decided, and reading
+    # every tile up front to hash it would undo that. This is deliberately
+    # narrower than routing by content. The same tile of the same image at
+    # the same tile size goes back to the same server and hits its result
+    # cache, but identical pixels elsewhere (another position, tile size or
+    # image) may land on a server that hasn't seen them. Those are still
+    # found by the shared disk cache, if servers have one.
+    return hashlib.blake2b(f"{tile.y0},{tile.y1},{tile.x0},{tile.x1}".encode("utf-8"), digest_size=16).digest()
+
+class HashRing:
+    # Consistent hashing of tile position keys (position_key) onto servers. A
+    # tile at a given position keeps going to the same server from job to
+    # job, and adding or removing a server only moves the tiles between it and
+    # its neighbours on the ring.
+    def __init__(self, servers, replicas=REPLICAS):
+        points = []
+        for server in servers:
+            for replica in range(replicas):
+                points.append((_point(f"{server[0]}:{server[1]}#{replica}".encode("utf-8")), server))
+        points.sort()
+        self.hashes = [point for point, _ in points]
+        self.servers = [server for _, server in points]
+        self.count = len(set(servers))
+
+    def candidates(self, key):
+        # Distinct servers in ring order, starting from the key's position
+        start = bisect.bisect(self.hashes, int.from_bytes(key[:8], "big"))
+        seen = set()
+        for offset in range(len(self.servers)):
+            server = self.servers[(start + offset) % len(self.servers)]
+            if server not in seen:
+                seen.add(server)
+                yield server
+                if len(seen) == self.count:
+                    return
+
+def assign(keys, servers, epsilon=LOAD_EPSILON, replicas=REPLICAS):
+    # Home server of each key: its first server on the ring that still has
+    # room under the load bound, so a run of keys hashing to one server spills
+    # over to the next ones instead of piling up there
+    ring = HashRing(servers, replicas)
+    capacity = max(1, math.ceil((1 + epsilon) * len(keys) / max(1, len(servers))))
+    load = {server: 0 for server in servers}
+    homes = []
+    for key in keys:
+        for server in ring.candidates(key):
+            if load[server] < capacity:
+                break
+        load[server] += 1
+        homes.append(server)
+    return homes
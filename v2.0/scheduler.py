@@ -0,0 +1,224 @@
+import time
+import threading
+import concurrent.futures
+from collections import deque
+from protocol import RemoteError
+
+# A tile still running after the HEDGE_PERCENTILE of recent tile latencies is
+# a straggler; an idle server then runs a duplicate and the first answer wins.
+# Hedging starts once HEDGE_MIN_SAMPLES tiles have finished and is limited to
+# MAX_COPIES attempts of a tile at once and HEDGE_FRACTION of all tiles.
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 5
+HEDGE_FRACTION = 0.1
+MAX_COPIES = 2
+# A tile is given up on after failing on MAX_ATTEMPTS servers. An attempt
+# times out after TIMEOUT_FACTOR times the hedge deadline (at least
+# MIN_TIMEOUT seconds), or after INITIAL_TIMEOUT before any tile has finished.
+MAX_ATTEMPTS = 3
+TIMEOUT_FACTOR = 4
+MIN_TIMEOUT = 5.0
+INITIAL_TIMEOUT = 60.0
+LATENCY_WINDOW = 64
+
+class Superseded(Exception):
+    # The attempt was abandoned because another copy of the tile finished first
+    pass
+
+class Attempt:
+    # One try of a tile on one server. process_part hands the request's future
+    # to wait(), which returns its result, raises TimeoutError once the
+    # attempt's time is up, or raises Superseded when a duplicate has won.
+    def __init__(self, index, server, timeout):
+        self.index = index
+        self.server = server
+        self.timeout = timeout
+        self.started = time.perf_counter()
+        self.cancelled = False
+        self.wakeup = threading.Event()
+
+    def cancel(self):
+        self.cancelled = True
+        self.wakeup.set()
+
+    def wait(self, future):
+        future.add_done_callback(lambda _: self.wakeup.set())
+        remaining = self.timeout - (time.perf_counter() - self.started)
+        self.wakeup.wait(max(0, remaining))
+        # Giving up cancels the request, so nothing it still streams back is
+        # delivered; one that completed in the meantime is used instead
+        if not future.cancel():
+            return future.result()
+        if self.cancelled:
+            raise Superseded(f"Tile {self.index} was finished by another server")
+        raise TimeoutError(f"Tile {self.index} timed out after {self.timeout:.1f} seconds")
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+def process_tiles(servers, parts, process_part, on_result=None, depth=1, max_hedges=None, max_attempts=MAX_ATTEMPTS, homes=None):
+    # Queues of tile indexes; every server pulls the next tile as soon as it
+    # finishes one, so faster servers end up doing more of the work. `homes`
+    # (from routing.assign) gives each tile a preferred server: servers take
+    # their own tiles first and only then steal from the back of the longest
+    # other queue. Without it all tiles are in one shared queue.
+    # `depth` workers per server keep that many tiles in flight on it.
+    # process_part(server, part, index, attempt) must wait for its request
+    # with attempt.wait(). A tile whose server fails or times out goes back to
+    # the queue for a different server, and stragglers are hedged as above.
+    homes = homes or [None] * len(parts)
+    queues = {}
+    for index, home in enumerate(homes):
+        queues.setdefault(home, deque()).append(index)
+    cond = threading.Condition()
+    running = {}  # index -> attempts in flight
+    failed_on = {index: set() for index in range(len(parts))}
+    latencies = deque(maxlen=LATENCY_WINDOW)
+    done = set()
+    tiles_per_server = {server: 0 for server in servers}
+    state = {"hedges": 0, "retries": 0, "stolen": 0, "error": None}
+    if max_hedges is None:
+        max_hedges = max(1, int(len(parts) * HEDGE_FRACTION))
+
+    def hedge_after():
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return percentile(latencies, HEDGE_PERCENTILE)
+
+    def timeout():
+        deadline = hedge_after()
+        return INITIAL_TIMEOUT if deadline is None else max(MIN_TIMEOUT, TIMEOUT_FACTOR * deadline)
+
+    def next_tile(server):
+        # Returns (index, hedged, seconds to wait before looking again).
+        # Called with cond held.
+        for home in (server, None):
+            queue = queues.get(home, ())
+            for index in queue:
+                if server not in failed_on[index]:
+                    queue.remove(index)
+                    return index, False, None
+        for home, queue in sorted(queues.items(), key=lambda item: -len(item[1])):
+            if home in (server, None):
+                continue
+            for index in reversed(queue):
+                if server not in failed_on[index]:
+                    queue.remove(index)
+                    state["stolen"] += 1
+                    return index, False, None
+        deadline = hedge_after()
+        if deadline is None or state["hedges"] >= max_hedges:
+            return None, False, None
+        now = time.perf_counter()
+        best, wait = None, None
+        for index, attempts in running.items():
+            # Finished tiles stay here until their losing copies notice the cancel
+            if index in done or len(attempts) >= MAX_COPIES or server in failed_on[index] or any(a.server == server for a in attempts):
+                continue
+            age = now - min(a.started for a in attempts)
+            if age >= deadline:
+                if best is None or age > best[1]:
+                    best = (index, age)
+            elif wait is None or deadline - age < wait:
+                wait = deadline - age
+        if best is not None:
+            return best[0], True, None
+        return None, False, wait
+
+    def finish(attempt):
+        # Called with cond held
+        running[attempt.index].remove(attempt)
+        if not running[attempt.index]:
+            del running[attempt.index]
+
+    def give_back(index, server):
+        # The tile failed on `server`: queue it for another one, or fail the
+        # image once it has failed on max_attempts servers. Called with cond held.
+        if index in done:
+            return
+        failed_on[index].add(server)
+        if len(failed_on[index]) >= max_attempts:
+            state["error"] = RuntimeError(f"Tile {index} failed on {len(failed_on[index])} servers")
+        elif index not in running:
+            queues[homes[index]].appendleft(index)
+            state["retries"] += 1
+
+    def worker(server):
+        while True:
+            with cond:
+                while True:
+                    if state["error"] is not None or len(done) == len(parts):
+                        return
+                    index, hedged, wait = next_tile(server)
+                    if index is not None:
+                        break
+                    # Nothing this server can take now; stop once nothing is
+                    # running that could fail back to the queue or straggle
+                    if not running:
+                        return
+                    cond.wait(wait)
+                if hedged:
+                    state["hedges"] += 1
+                    print(f"Tile {index} is straggling, sending a duplicate to {server[0]}:{server[1]}")
+                attempt = Attempt(index, server, timeout())
+                running.setdefault(index, []).append(attempt)
+
+            try:
+                result = process_part(server, parts[index], index, attempt)
+            except Superseded:
+                with cond:
+                    finish(attempt)
+                    cond.notify_all()
+                continue
+            except RemoteError as e:
+                # The server is up but couldn't process the tile: hand the
+                # tile back for a different server and keep using this one
+                print(f"Server {server[0]}:{server[1]} could not process tile {index}: {e}")
+                with cond:
+                    finish(attempt)
+                    give_back(index, server)
+                    cond.notify_all()
+                continue
+            except (OSError, EOFError) as e:
+                # Hand the tile back for a different server and stop using this one
+                print(f"Server {server[0]}:{server[1]} failed on tile {index}: {e}")
+                with cond:
+                    finish(attempt)
+                    give_back(index, server)
+                    cond.notify_all()
+                return
+            except Exception as e:
+                with cond:
+                    finish(attempt)
+                    state["error"] = state["error"] or e
+                    cond.notify_all()
+                raise
+            with cond:
+                latencies.append(time.perf_counter() - attempt.started)
+                # Any duplicate still running has lost; its worker removes it
+                # once it sees the cancel
+                for other in running[index]:
+                    if other is not attempt:
+                        other.cancel()
+                finish(attempt)
+                if index not in done:
+                    if on_result is not None:
+                        on_result(*result)
+                    done.add(index)
+                    tiles_per_server[server] += 1
+                cond.notify_all()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(servers) * depth) as executor:
+        futures = [executor.submit(worker, server) for server in servers for _ in range(depth)]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+    if state["hedges"] or state["retries"] or state["stolen"]:
+        print(f"Hedged {state['hedges']} straggling tiles, retried {state['retries']} failed tiles "
+              f"and moved {state['stolen']} tiles off their home servers")
+    if state["error"] is not None:
+        raise state["error"]
+    if len(done) != len(parts):
+        raise RuntimeError(f"{len(parts) - len(done)} tiles could not be processed: all servers failed")
+    return tiles_per_server
@@ -0,0 +1,425 @@
+import cv2
+import time
+import os
+import json
+import socket
+import signal
+import argparse
+import asyncio
+import threading
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from compute import make_backend, default_workers
+from writer import DiskWriter, FORMATS
+from cache import ResultCache, CACHE_BYTES, request_key
+from pipeline import PARTIAL_OUTPUTS
+from protocol import REQUEST, RESPONSE, ERROR, HELLO, OUTPUT, FrameProtocol, load_json, encode_arrays, decode_arrays, array_shapes
+from codec import LinkEstimator, available_codecs, make_codec, negotiate
+from registry import Heartbeat, node_id, parse_address
+from timing import StageTimes
+from metrics import Metrics, MetricsServer
+from tracing import thread_id
+
+class LoadStats:
+    # Load figures for registry heartbeats: tiles waiting for a compute slot,
+    # tiles being computed, the pixels in both, a moving average of how many
+    # pixels per second a single compute worker gets through, and the seconds
+    # spent in each stage of handling requests since the server started
+    def __init__(self, workers, weight=0.3):
+        self.workers = workers
+        self.weight = weight
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+        self.pending_pixels = 0
+        self.pixels_per_second = 0.0
+        self.times = StageTimes()
+
+    def received(self, pixels):
+        with self.lock:
+            self.queued += 1
+            self.pending_pixels += pixels
+
+    def started(self):
+        with self.lock:
+            self.queued -= 1
+            self.in_flight += 1
+
+    def finished(self, pixels, seconds=None):
+        # `seconds` is None when the request failed and says nothing about speed
+        with self.lock:
+            self.in_flight -= 1
+            self.pending_pixels -= pixels
+            if seconds:
+                rate = pixels / seconds
+                self.pixels_per_second = rate if not self.pixels_per_second else self.pixels_per_second + self.weight * (rate - self.pixels_per_second)
+
+    def report(self, node, address):
+        with self.lock:
+            return {"node": node, "address": list(address), "workers": self.workers, "queued": self.queued,
+                    "in_flight": self.in_flight, "pending_pixels": self.pending_pixels, "pixels_per_second": self.pixels_per_second,
+                    "stage_seconds": self.times.snapshot()}
+
+class RequestTimes(StageTimes):
+    # Where one request's time went on this server, by stage (receive, queue,
+    # decode, compute, serialize, send, save) and by pipeline op. It goes back
+    # to the client as the RESPONSE payload. "send" is time spent waiting for
+    # the client to drain the connection and queueing frames on the loop.
+    # Requests that carry a trace id (tracing.py) also record every stage and
+    # op as a span, returned with the rest.
+    def __init__(self, receive_seconds, bytes_in, trace_id=None):
+        super().__init__()
+        self.received_at = time.perf_counter()
+        self.trace_id = trace_id
+        self.spans = [] if trace_id is not None else None
+        self.op_spans = [] if trace_id is not None else None
+        self.add("receive", receive_seconds)
+        self.ops = {}
+        self.bytes_in = bytes_in
+        self.bytes_out = 0
+        self.cached = False
+
+    def add(self, stage, seconds, span=True):
+        # Spans end now; pass span=False for time that wasn't one stretch
+        super().add(stage, seconds)
+        if span:
+            self.span(stage, time.time() - seconds, seconds)
+
+    def span(self, name, start, seconds):
+        if self.spans is not None:
+            self.spans.append((name, start, seconds, thread_id()))
+
+    def report(self):
+        stages = self.snapshot()
+        total = stages["receive"] + time.perf_counter() - self.received_at
+        report = {"stages": stages, "ops": dict(self.ops), "cached": self.cached, "total": total,
+                  "bytes_in": self.bytes_in, "bytes_out": self.bytes_out}
+        if self.spans is not None:
+            report["trace"] = {"spans": self.spans + self.op_spans, "clock": time.time()}
+        return report
+
+class ServerMetrics:
+    # Counters and latency histograms for the metrics endpoint, plus gauges
+    # read from the server's load figures and disk writer
+    def __init__(self, stats, writer):
+        self.registry = Metrics()
+        self.requests = self.registry.counter("server_requests_total", "Requests handled")
+        self.errors = self.registry.counter("server_errors_total", "Requests that failed")
+        self.cache_hits = self.registry.counter("server_cache_hits_total", "Requests answered from the result cache")
+        self.bytes_in = self.registry.counter("server_bytes_received_total", "Request payload bytes received")
+        self.bytes_out = self.registry.counter("server_bytes_sent_total", "Output payload bytes sent")
+        self.request_seconds = self.registry.histogram("server_request_seconds", "Time from receiving a request to its response")
+        self.queue_seconds = self.registry.histogram("server_queue_wait_seconds", "Time requests waited for a compute slot")
+        self.stage_seconds = self.registry.histogram("server_stage_seconds", "Time per request spent in each stage")
+        self.op_seconds = self.registry.histogram("server_op_seconds", "Time per request spent in each pipeline op")
+        self.registry.gauge("server_queued_requests", "Requests waiting for a compute slot", lambda: stats.queued)
+        self.registry.gauge("server_in_flight_requests", "Requests being computed", lambda: stats.in_flight)
+        self.registry.gauge("server_save_queue_depth", "Images waiting to be written to disk", lambda: writer.queue.qsize())
+        self.registry.gauge("server_saves_dropped_total", "Images not written because the disk fell behind", lambda: writer.dropped)
+
+    def record(self, report, failed=False):
+        self.requests.inc()
+        self.bytes_in.inc(report["bytes_in"])
+        self.bytes_out.inc(report["bytes_out"])
+        if failed:
+            self.errors.inc()
+            return
+        if report["cached"]:
+            self.cache_hits.inc()
+        self.request_seconds.observe(report["total"])
+        self.queue_seconds.observe(report["stages"].get("queue", 0.0))
+        for stage, seconds in report["stages"].items():
+            self.stage_seconds.observe(seconds, stage=stage)
+        for op, seconds in report["ops"].items():
+            self.op_seconds.observe(seconds, op=op)
+
+def send_image_data(conn, request_id, image_data, codec, times, kind=OUTPUT):
+    # Encode each output as a typed array with the connection's codec and
+    # queue the frame on the event loop
+    with times.measure("serialize"):
+        buffers = encode_arrays(image_data, codec)
+    with times.measure("send"):
+        conn.send(kind, request_id, *buffers)
+    times.bytes_out += sum(memoryview(buffer).nbytes for buffer in buffers)
+
+def send_response(conn, request_id, times):
+    conn.send(RESPONSE, request_id, json.dumps(times.report()).encode("utf-8"))
+
+def handle_request(conn, request_id, data, codec, backend, writer, cache, times):
+    # Runs on the compute executor. Returns False if the results came from the
+    # cache. The cache key is hashed from the decoded tile (cache.request_key),
+    # so it doesn't depend on the codec the tile came with, and a cache hit
+    # needs no processing. Time spent is recorded on `times` (a RequestTimes)
+    # and reported with the response.
+
+    # Decode the image data, and the outputs wanted and the tile's core region
+    # if the client sent them (all outputs, over the whole tile, otherwise)
+    decode_started = time.perf_counter()
+    request = decode_arrays(data, ("image", "outputs", "core"))
+    times.add("decode", time.perf_counter() - decode_started)
+
+    key = None
+    if cache is not None:
+        key = request_key(request)
+        cached = cache.get(key) if key is not None else None
+        if cached is not None:
+            times.cached = True
+            for name, processed_image in cached.items():
+                send_image_data(conn, request_id, {name: processed_image}, codec, times)
+            send_response(conn, request_id, times)
+            print(f"Request {request_id}: served from the result cache")
+            return False
+
+    decode_started = time.perf_counter()
+    image_part = request["image"]
+    outputs = bytes(request["outputs"]).decode("utf-8").split(",") if "outputs" in request else None
+    core = tuple(int(value) for value in request["core"]) if "core" in request else None
+    print(f"Request {request_id}: image decoded successfully")
+    print(f"Image shape: {image_part.shape}")
+
+    # Convert RGB to BGR if necessary
+    if image_part.shape[2] == 3:  # Check if the image has 3 channels (RGB)
+        image_part = cv2.cvtColor(image_part, cv2.COLOR_RGB2BGR)
+    times.add("decode", time.perf_counter() - decode_started)
+
+    # Queue the received image part to be saved in the background
+    tag = f"{conn.addr[1]}_{request_id}"
+    with times.measure("save"):
+        writer.save(f"received_part_{tag}", image_part)
+
+    # Outputs are only kept for the result cache, and only if it will take them
+    results = {} if key is not None else None
+    # Outputs are sent from inside the pipeline run; that time isn't compute
+    handed_off = [0.0]
+
+    def send_output(name, processed_image):
+        # Stream each output to the client as soon as it is computed, then queue it for saving
+        started = time.perf_counter()
+        send_image_data(conn, request_id, {name: processed_image}, codec, times)
+        if name not in PARTIAL_OUTPUTS:
+            with times.measure("save"):
+                writer.save(f"{name}_part_{tag}", processed_image)
+        if results is not None:
+            results[name] = processed_image
+        handed_off[0] += time.perf_counter() - started
+
+    # Process the image part
+    start = time.time()
+    start_time = time.perf_counter()
+    backend.run(image_part, send_output, outputs, core, times.ops, times.op_spans)
+    processing_time = time.perf_counter() - start_time
+    times.add("compute", processing_time - handed_off[0], span=False)
+    times.span("compute", start, processing_time)
+
+    # Tell the client every output for this request has been sent, and where the time went
+    send_response(conn, request_id, times)
+    if key is not None:
+        cache.put(key, results)
+
+    print(f"Processing time on server {conn.addr[1]}: {processing_time:.2f} seconds")
+    return True
+
+def serve_request(conn, request_id, data, codec, backend, writer, cache, stats, metrics, times, pixels):
+    # Report failures to the client instead of leaving its request unanswered
+    stats.started()
+    times.add("queue", time.perf_counter() - times.received_at)
+    start_time = time.perf_counter()
+    try:
+        computed = handle_request(conn, request_id, data, codec, backend, writer, cache, times)
+    except Exception as e:
+        stats.finished(pixels)
+        metrics.record(times.report(), failed=True)
+        print(f"Request {request_id} from {conn.addr} failed: {e}")
+        try:
+            conn.send(ERROR, request_id, str(e).encode("utf-8"))
+        except OSError:
+            pass
+    else:
+        # Cache hits say nothing about how fast this server computes
+        stats.finished(pixels, time.perf_counter() - start_time if computed else None)
+        report = times.report()
+        for stage, seconds in report["stages"].items():
+            stats.times.add(stage, seconds)
+        metrics.record(report)
+
+class ClientConnection(FrameProtocol):
+    # One client connection. The event loop does all of its socket I/O;
+    # each tile is handed to the compute executor, so slow uploads or
+    # downloads never hold a compute slot and many tiles can be in flight.
+    def __init__(self, executor, backend, writer, cache, stats, metrics):
+        super().__init__(LinkEstimator())
+        self.executor = executor
+        self.backend = backend
+        self.writer = writer
+        self.cache = cache
+        self.stats = stats
+        self.metrics = metrics
+        # Clients that skip the handshake get zlib at its default level
+        self.codec = make_codec("zlib:6")
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.addr = transport.get_extra_info("peername")
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        print(f"Connected by {self.addr}")
+
+    def frame_received(self, kind, request_id, data):
+        if kind == HELLO:
+            hello = load_json(data)
+            spec = negotiate(hello["codecs"])
+            self.codec = make_codec(spec, self.link, hello.get("supported"))
+            answer = json.dumps({"codec": spec, "supported": available_codecs()}).encode("utf-8")
+            self.write_frame(HELLO, request_id, answer)
+            print(f"Using codec {spec} with {self.addr}")
+        elif kind == REQUEST:
+            print(f"Received request {request_id} with {len(data)} bytes of image data")
+            height, width = array_shapes(data)["image"][:2]
+            self.stats.received(height * width)
+            trace = decode_arrays(data, ("trace",)).get("trace")
+            times = RequestTimes(self.receive_seconds, len(data), int(trace[0]) if trace is not None else None)
+            self.loop.run_in_executor(self.executor, serve_request, self, request_id, data, self.codec, self.backend, self.writer,
+                                      self.cache, self.stats, self.metrics, times, height * width)
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        print(f"Disconnected {self.addr}")
+
+async def serve(host, port, writer, compute_workers, backend_name, cores=None, reuse_port=False, registry=None, advertise=None, cache=None,
+                metrics_address=None):
+    loop = asyncio.get_running_loop()
+    backend = make_backend(backend_name, compute_workers, cores)
+    stats = LoadStats(compute_workers)
+    metrics = ServerMetrics(stats, writer)
+    heartbeat = None
+    metrics_server = None
+    try:
+        with ThreadPoolExecutor(max_workers=compute_workers) as executor:
+            server = await loop.create_server(lambda: ClientConnection(executor, backend, writer, cache, stats, metrics), host, port,
+                                              reuse_port=reuse_port or None)
+            print(f"Server {os.getpid()} listening on {host}:{port} with {compute_workers} {backend.name} compute workers, {backend.opencv_threads} OpenCV threads each")
+            if metrics_address is not None:
+                metrics_server = MetricsServer(metrics.registry, *metrics_address)
+                print(f"Serving metrics on http://{metrics_address[0]}:{metrics_address[1]}/metrics")
+            if registry is not None:
+                # Clients find this server through the registry at the address they should connect to
+                node, address = node_id(), (advertise or host, port)
+                heartbeat = Heartbeat(registry, lambda: stats.report(node, address))
+            async with server:
+                await server.serve_forever()
+    finally:
+        if heartbeat is not None:
+            heartbeat.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        backend.close()
+        writer.close()
+        if cache is not None:
+            cache.close()
+
+def start_server(host, port, writer, compute_workers=4, backend="thread", cores=None, reuse_port=False, registry=None, advertise=None,
+                 cache=None, metrics_address=None):
+    # Network I/O for every connection runs on one asyncio event loop; image
+    # decoding and processing run on a separately sized pool of compute
+    # threads. With the "process" backend each of those threads hands its
+    # tile to a worker process through shared memory. Received and processed
+    # parts are saved by `writer` in the background. `cores` is this
+    # process's share of the machine when several listeners share the port.
+    # With a `registry` (host, port) the server reports its load there so
+    # clients can find it; `advertise` is the host clients should connect to.
+    # Tiles whose results are in `cache` (a ResultCache) are not recomputed.
+    # With a `metrics_address` (host, port), counters and latency histograms
+    # are served over HTTP at /metrics.
+    asyncio.run(serve(host, port, writer, compute_workers, backend, cores, reuse_port, registry, advertise, cache, metrics_address))
+
+def run_listener(args):
+    # One listener process, with its own event loop, compute pool and disk writer
+    writer = DiskWriter(args.output_dir, args.save_format, args.save_level, args.save, args.save_queue, args.save_policy)
+    cache = ResultCache(args.cache_mb * 1024 * 1024, args.cache_dir) if args.cache_mb or args.cache_dir else None
+    cores = max(1, default_workers() // args.processes)
+    metrics_address = (args.metrics_host, args.metrics_port) if args.metrics_port else None
+    try:
+        start_server(args.host, args.port, writer, args.compute_workers, args.backend, cores, args.processes > 1,
+                     args.registry, args.advertise, cache, metrics_address)
+    except KeyboardInterrupt:
+        pass
+
+def parse_args(argv=None, default_port=65432):
+    # Every option can also be set through a SERVER_* environment variable
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description="Distributed image processing server")
+    parser.add_argument("--host", default=env("SERVER_HOST", "127.0.0.1"), help="address to listen on")
+    parser.add_argument("--port", type=int, default=int(env("SERVER_PORT", default_port)))
+    parser.add_argument("--processes", type=int, default=int(env("SERVER_PROCESSES", 1)),
+                        help="listener processes sharing the port through SO_REUSEPORT")
+    parser.add_argument("--compute-workers", type=int, default=int(env("SERVER_COMPUTE_WORKERS", 0)),
+                        help="tiles processed at once per listener process (default: its share of the cores)")
+    parser.add_argument("--backend", choices=["thread", "blocks", "process"], default=env("SERVER_BACKEND", "thread"),
+                        help='"blocks" splits each tile across all cores, "process" runs the pipeline in worker processes')
+    parser.add_argument("--output-dir", default=env("SERVER_OUTPUT_DIR", "server_output"), help="directory to save server images")
+    parser.add_argument("--no-save", dest="save", action="store_false", default=env("SERVER_SAVE", "1") != "0",
+                        help="don't save received and processed parts")
+    parser.add_argument("--save-format", choices=sorted(FORMATS), default=env("SERVER_SAVE_FORMAT", "png"))
+    parser.add_argument("--save-level", type=int, default=int(env("SERVER_SAVE_LEVEL", 1)), help="PNG compression level, 0-9")
+    parser.add_argument("--save-queue", type=int, default=int(env("SERVER_SAVE_QUEUE", 64)),
+                        help="images waiting to be written before the policy applies")
+    parser.add_argument("--save-policy", choices=["block", "drop"], default=env("SERVER_SAVE_POLICY", "block"),
+                        help='when the disk falls behind, "block" slows processing down and "drop" skips files')
+    parser.add_argument("--cache-mb", type=int, default=int(env("SERVER_CACHE_MB", CACHE_BYTES // (1024 * 1024))),
+                        help="memory for cached tile results per listener process, 0 to keep none in memory")
+    parser.add_argument("--cache-dir", default=env("SERVER_CACHE_DIR"),
+                        help="directory for a persistent result cache shared by every process using it")
+    parser.add_argument("--registry", type=parse_address, default=env("SERVER_REGISTRY"),
+                        help="host:port of the registry to send heartbeats to")
+    parser.add_argument("--advertise", default=env("SERVER_ADVERTISE"),
+                        help="host clients should use to reach this server (default: --host, or this machine's name)")
+    parser.add_argument("--metrics-port", type=int, default=int(env("SERVER_METRICS_PORT", 0)),
+                        help="port to serve /metrics on over HTTP, 0 for none; listener processes use the ports from here up")
+    parser.add_argument("--metrics-host", default=env("SERVER_METRICS_HOST", "127.0.0.1"), help="address to serve metrics on")
+    args = parser.parse_args(argv)
+    if args.processes < 1:
+        parser.error("--processes must be at least 1")
+    if args.processes > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("--processes above 1 needs SO_REUSEPORT, which this platform lacks")
+    if args.advertise is None:
+        args.advertise = socket.gethostname() if args.host in ("", "0.0.0.0", "::") else args.host
+    if args.compute_workers < 1:
+        args.compute_workers = max(1, default_workers() // args.processes)
+    return args
+
+def main(argv=None, default_port=65432):
+    args = parse_args(argv, default_port)
+    if args.processes == 1:
+        run_listener(args)
+        return
+
+    # Each process binds the same port with SO_REUSEPORT and the kernel
+    # spreads incoming connections across them
+    context = mp.get_context("spawn")
+    listeners = []
+    for i in range(args.processes):
+        # Listeners can't share the metrics port, so each gets its own
+        listener_args = argparse.Namespace(**vars(args))
+        if args.metrics_port:
+            listener_args.metrics_port = args.metrics_port + i
+        listeners.append(context.Process(target=run_listener, args=(listener_args,)))
+    for listener in listeners:
+        listener.start()
+    # Stop the listeners cleanly whether this process gets Ctrl-C or SIGTERM
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f"Started {len(listeners)} listener processes on {args.host}:{args.port}")
+    try:
+        for listener in listeners:
+            listener.join()
+    except KeyboardInterrupt:
+        for listener in listeners:
+            if listener.is_alive():
+                os.kill(listener.pid, signal.SIGINT)
+        for listener in listeners:
+            listener.join(timeout=10)
+            if listener.is_alive():
+                listener.terminate()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,32 @@
+import statistics
+from bench_ops import run, compare
+
+# compare must only flag ops that really got slower, not the noise between
+# two runs of the same code
+
+OPS = ["gray", "blurred", "thresholded", "sharpened"]
+
+def entry(op, rounds):
+    return {"op": op, "size": 64, "channels": 3, "rounds": rounds, "median": statistics.median(rounds)}
+
+def interleaved_runs(rounds):
+    # Two runs of the same code with their rounds taken in turn, so that the
+    # machine speeding up or slowing down meanwhile affects both alike
+    runs = [{}, {}]
+    for _ in range(rounds):
+        for results in runs:
+            for measured in run([64, 128], [3], OPS, rounds=1, samples=3, min_time=0.005):
+                merged = results.setdefault((measured["op"], measured["size"]), dict(measured, rounds=[]))
+                merged["rounds"] += measured["rounds"]
+                merged["median"] = statistics.median(merged["rounds"])
+    return [{"results": list(results.values())} for results in runs]
+
+def test_same_code_does_not_regress():
+    baseline, current = interleaved_runs(5)
+    assert compare(baseline, current, alpha=0.01, threshold=0.05) == []
+
+def test_slower_op_regresses():
+    rounds = [1.0, 1.02, 0.98, 1.01, 0.99]
+    baseline = {"results": [entry("gray", rounds), entry("blurred", rounds)]}
+    current = {"results": [entry("gray", [2 * value for value in rounds]), entry("blurred", rounds)]}
+    assert [regressed["op"] for regressed in compare(baseline, current, alpha=0.01, threshold=0.05)] == ["gray"]
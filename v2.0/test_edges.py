@@ -0,0 +1,31 @@
+import os
+import cv2
+import pytest
+from pipeline import process_image, required_halo
+from reduction import tiled_outputs, finish_outputs
+from tiling import tiles_of_size, extract_tile, tile_core, crop_halo, Canvas
+
+# Tiled edges must match Canny over the whole image exactly, seams included
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def tiled_edges(image, tile_size):
+    # What the client assembles from the servers' edge candidates
+    outputs = tiled_outputs(["edges"])
+    height, width = image.shape[:2]
+    tiles = tiles_of_size(height, width, tile_size, tile_size, required_halo(outputs))
+    canvases = {name: Canvas(tiles) for name in ("edges",) + outputs}
+    for tile in tiles:
+        parts = process_image(extract_tile(image, tile), outputs, core=tile_core(tile))
+        for name, part in parts.items():
+            canvases[name].place(tile, crop_halo(part, tile))
+    finish_outputs(["edges"], tiles, {}, canvases, None)
+    return canvases["edges"].array
+
+# Canny run on each tile with a halo gets up to thousands of these pixels wrong
+@pytest.mark.parametrize("name", ["photo.tiff", "sea.tiff"])
+@pytest.mark.parametrize("tile_size", [100, 256, 512])
+def test_tiled_edges_match_whole_image(name, tile_size):
+    image = cv2.imread(os.path.join(HERE, name))
+    expected = process_image(image, ["edges"])["edges"]
+    assert (tiled_edges(image, tile_size) != expected).sum() == 0
@@ -0,0 +1,120 @@
+import os
+import math
+import threading
+import numpy as np
+from collections import namedtuple
+
+# A tile is its core region [y0:y1, x0:x1] in image coordinates plus the ghost
+# border (halo) read around it. The halo is clamped at the image edges, so
+# edge tiles see the same border handling as processing the whole image.
+Tile = namedtuple("Tile", ["index", "row", "col", "y0", "y1", "x0", "x1", "top", "bottom", "left", "right"])
+
+def grid_shape(count, height, width):
+    # Pick rows x cols with rows * cols == count whose cells are closest to square
+    best = (count, 1)
+    for rows in range(1, count + 1):
+        if count % rows:
+            continue
+        cols = count // rows
+        if abs(math.log((height / rows) / (width / cols))) < abs(math.log((height / best[0]) / (width / best[1]))):
+            best = (rows, cols)
+    return best
+
+def _bounds(length, count, align=1):
+    # Split `length` into `count` near-equal spans, starting on multiples of `align`
+    return [(length * i // count + align // 2) // align * align for i in range(count)] + [length]
+
+def grid_tiles(height, width, rows, cols, halo=0, align=1):
+    ys = _bounds(height, rows, align)
+    xs = _bounds(width, cols, align)
+    tiles = []
+    for row in range(rows):
+        for col in range(cols):
+            y0, y1, x0, x1 = ys[row], ys[row + 1], xs[col], xs[col + 1]
+            tiles.append(Tile(
+                len(tiles), row, col, y0, y1, x0, x1,
+                min(halo, y0), min(halo, height - y1),
+                min(halo, x0), min(halo, width - x1)
+            ))
+    return tiles
+
+def strip_tiles(height, width, count, halo=0):
+    # Horizontal strips keep each tile contiguous in memory
+    return grid_tiles(height, width, count, 1, halo)
+
+def tiles_of_size(height, width, tile_height, tile_width, halo=0, align=1):
+    # Grid whose cells are at most tile_height x tile_width, give or take
+    # `align` - 1 pixels when their edges must fall on multiples of `align`
+    rows = max(1, -(-height // tile_height))
+    cols = max(1, -(-width // tile_width))
+    return grid_tiles(height, width, rows, cols, halo, align)
+
+def tile_bounds(tile):
+    # (y0, y1, x0, x1) of the tile's core plus its halo
+    return tile.y0 - tile.top, tile.y1 + tile.bottom, tile.x0 - tile.left, tile.x1 + tile.right
+
+def extract_tile(image, tile):
+    # View of the tile's core plus its halo; no copy is made
+    y0, y1, x0, x1 = tile_bounds(tile)
+    return image[y0:y1, x0:x1]
+
+def tile_core(tile):
+    # (top, left, height, width) of the tile's core within its haloed extract
+    return (tile.top, tile.left, tile.y1 - tile.y0, tile.x1 - tile.x0)
+
+def scale_tile(tile, level):
+    # The tile's core at 1 / 2 ** level of the size, as a tile with no halo
+    scale = 2 ** level
+    return tile._replace(y0=tile.y0 // scale, y1=-(-tile.y1 // scale), x0=tile.x0 // scale, x1=-(-tile.x1 // scale),
+                         top=0, bottom=0, left=0, right=0)
+
+def crop_halo(output, tile):
+    # Drop the ghost border from a processed tile
+    return output[tile.top:tile.top + tile.y1 - tile.y0, tile.left:tile.left + tile.x1 - tile.x0]
+
+class Canvas:
+    # One output image assembled in place: each tile's part is copied straight
+    # into its slot as it arrives, so assembly costs a single copy. Aligned
+    # outputs go to the tile's core region; outputs of a fixed size per tile
+    # (e.g. "resized") are laid out as a grid of those blocks. The array is
+    # allocated when the first part arrives, once its dtype and channels are
+    # known. With `path` it is a memory-mapped .npy file, so an output can be
+    # bigger than RAM.
+    def __init__(self, tiles, aligned=True, path=None):
+        self.aligned = aligned
+        self.path = path
+        self.rows = max(tile.row for tile in tiles) + 1
+        self.cols = max(tile.col for tile in tiles) + 1
+        self.height = max(tile.y1 for tile in tiles)
+        self.width = max(tile.x1 for tile in tiles)
+        self.array = None
+        self.lock = threading.Lock()
+
+    def _allocate(self, part):
+        if self.aligned:
+            shape = (self.height, self.width) + part.shape[2:]
+        else:
+            shape = (self.rows * part.shape[0], self.cols * part.shape[1]) + part.shape[2:]
+        if self.path is None:
+            return np.empty(shape, dtype=part.dtype)
+        return np.lib.format.open_memmap(self.path, mode="w+", dtype=part.dtype, shape=shape)
+
+    def place(self, tile, part):
+        # Parts of different tiles can be placed from several threads at once
+        with self.lock:
+            if self.array is None:
+                self.array = self._allocate(part)
+        self.region(tile)[...] = part
+
+    def region(self, tile):
+        # The tile's slot in the array, as a view
+        if self.aligned:
+            return self.array[tile.y0:tile.y1, tile.x0:tile.x1]
+        height, width = self.array.shape[0] // self.rows, self.array.shape[1] // self.cols
+        return self.array[tile.row * height:(tile.row + 1) * height, tile.col * width:(tile.col + 1) * width]
+
+    def close(self):
+        # Drop the array, deleting its backing file if it had one
+        self.array = None
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,30 @@
+import time
+import threading
+from contextlib import contextmanager
+
+class StageTimes:
+    # Seconds spent in each stage of processing (load, encode, compute, ...),
+    # summed over every thread that records into it, so stages that overlap
+    # can add up to more than the wall-clock time. Untraced; tracing.TracedTimes
+    # wraps one to also record spans of a trace.
+    trace = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = {}
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def measure(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.seconds)
@@ -0,0 +1,106 @@
+import json
+import time
+import random
+import threading
+from contextlib import contextmanager
+
+# Traces follow one image through the client and every server that handled
+# its tiles. The client decides whether an image is traced (head sampling)
+# and sends the trace id with each of its tiles; servers record spans only
+# for tiles that carry one and return them with the response. Spans are
+# (name, start, seconds, thread), with `start` in wall-clock seconds of the
+# machine that recorded them, and are exported in the Chrome trace-event
+# format that chrome://tracing and Perfetto open.
+
+def new_trace_id():
+    return random.getrandbits(63) or 1
+
+def thread_id():
+    return threading.get_native_id()
+
+class Tracer:
+    # Samples traces and collects their spans, from this process and from
+    # servers, for export. `sample_rate` is the fraction of traces kept.
+    def __init__(self, sample_rate=1.0, name="client"):
+        self.sample_rate = sample_rate
+        self.name = name
+        self.lock = threading.Lock()
+        self.processes = {name: 1}
+        self.events = []
+
+    def start(self, name, **args):
+        # A new trace, or None if this one isn't sampled
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        return Trace(self, new_trace_id(), name, args)
+
+    def record(self, process, trace_id, name, start, seconds, thread, args=None):
+        with self.lock:
+            pid = self.processes.setdefault(process, len(self.processes) + 1)
+            self.events.append({"name": name, "ph": "X", "ts": start * 1e6, "dur": seconds * 1e6, "pid": pid, "tid": thread,
+                                "args": dict(args or {}, trace=f"{trace_id:016x}")})
+
+    def export(self, path):
+        # Writes every span as Chrome trace-event JSON, timestamps relative to the first span
+        with self.lock:
+            events = list(self.events)
+            processes = dict(self.processes)
+        origin = min((event["ts"] for event in events), default=0.0)
+        for event in events:
+            event["ts"] -= origin
+        names = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": process}} for process, pid in processes.items()]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": names + events, "displayTimeUnit": "ms"}, f)
+        return len(events)
+
+class Trace:
+    # One sampled trace: spans recorded here go to the tracer under its id
+    def __init__(self, tracer, trace_id, name, args=None):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.name = name
+        self.args = args or {}
+
+    def record(self, name, start, seconds, args=None):
+        self.tracer.record(self.tracer.name, self.trace_id, name, start, seconds, thread_id(), args)
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.time()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter() - started, args)
+
+    def add_remote(self, process, report, sent_at, answered_at):
+        # Spans a server returned for one request, which was sent at `sent_at`
+        # and answered at `answered_at` on this clock. The server's clock is
+        # mapped onto ours from the midpoints of the exchange, as in NTP: its
+        # first span starts when the request arrives and `report["clock"]` is
+        # its time when it answered.
+        spans = report["spans"]
+        if not spans:
+            return
+        arrived = min(span[1] for span in spans)
+        offset = ((arrived - sent_at) + (report["clock"] - answered_at)) / 2
+        for name, start, seconds, thread, *args in spans:
+            self.tracer.record(process, self.trace_id, name, start - offset, seconds, thread, args[0] if args else None)
+
+class TracedTimes:
+    # Stands in for a timing.StageTimes: measured stages are still added to
+    # `times`, and also recorded as spans of `trace`
+    def __init__(self, times, trace):
+        self.times = times
+        self.trace = trace
+
+    def add(self, stage, seconds):
+        self.times.add(stage, seconds)
+
+    @contextmanager
+    def measure(self, stage):
+        with self.trace.span(stage), self.times.measure(stage):
+            yield
+
+    def snapshot(self):
+        return self.times.snapshot()
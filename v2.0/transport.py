@@ -0,0 +1,216 @@
+import socket
+import threading
+import itertools
+from concurrent.futures import Future, InvalidStateError
+from protocol import REQUEST, RESPONSE, ERROR, HELLO, OUTPUT, RemoteError, send_frame, recv_frame, send_json, load_json
+from codec import LinkEstimator, available_codecs, make_codec
+
+def settle(future, result=None, error=None):
+    # Resolve a request's future unless it was resolved or cancelled already
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+class Connection:
+    # One long-lived socket to a server. Requests are tagged with ids and sent
+    # under a lock; a reader thread passes each streamed output to the
+    # request's callback and resolves its future when the request completes,
+    # so many requests can be in flight at once. Cancelling a request's future
+    # abandons it: its callback is not called again once cancel() returns.
+    # A retired connection takes no part in the pool any more and closes once
+    # the requests still on it have finished or been abandoned.
+    def __init__(self, host, port, timeout=10, codec="auto"):
+        self.address = (host, port)
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.link = LinkEstimator()
+        try:
+            self.codec = self._negotiate(codec)
+        except (OSError, EOFError):
+            self.sock.close()
+            raise
+        self.sock.settimeout(None)
+        self.send_lock = threading.Lock()
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.deliver_lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.closed = False
+        self.retiring = False
+        self.reader = threading.Thread(target=self._read_loop, daemon=True)
+        self.reader.start()
+
+    def _negotiate(self, codec):
+        # Offer the wanted codec with safe fallbacks; both sides then encode
+        # with whichever one the server picked
+        offer = list(dict.fromkeys([codec, "zlib:6", "raw"]))
+        send_json(self.sock, HELLO, 0, {"codecs": offer, "supported": available_codecs()})
+        frame = recv_frame(self.sock)
+        if frame is None or frame[0] != HELLO:
+            raise ConnectionError(f"{self.address[0]}:{self.address[1]} did not answer the codec handshake")
+        answer = load_json(frame[2])
+        return make_codec(answer["codec"], self.link, answer.get("supported"))
+
+    def request(self, *buffers, on_output=None):
+        # on_output(payload) is called from the reader thread for every OUTPUT frame
+        future = Future()
+        request_id = next(self.ids)
+        with self.pending_lock:
+            if self.closed:
+                raise ConnectionError(f"Connection to {self.address[0]}:{self.address[1]} is closed")
+            self.pending[request_id] = (future, on_output)
+        # A caller that gives up on the request cancels its future
+        future.add_done_callback(lambda f: f.cancelled() and self._forget(request_id))
+        try:
+            with self.send_lock:
+                send_frame(self.sock, REQUEST, request_id, *buffers)
+        except OSError as e:
+            self._fail(e)
+        return future
+
+    def _read_loop(self):
+        try:
+            while True:
+                frame = recv_frame(self.sock, self.link)
+                if frame is None:
+                    raise EOFError("Connection closed by server")
+                kind, request_id, payload = frame
+                with self.deliver_lock:
+                    with self.pending_lock:
+                        if kind == OUTPUT:
+                            entry = self.pending.get(request_id)
+                        else:
+                            entry = self.pending.pop(request_id, None)
+                        drained = self._drained()
+                    if entry is None:
+                        continue
+                    future, on_output = entry
+                    if kind == OUTPUT:
+                        if on_output is not None:
+                            self._deliver(request_id, future, on_output, payload)
+                    elif kind == RESPONSE:
+                        settle(future, result=payload)
+                    elif kind == ERROR:
+                        settle(future, error=RemoteError(bytes(payload).decode("utf-8", "replace")))
+                if drained:
+                    self.close()
+                    return
+        except (OSError, EOFError) as e:
+            self._fail(e)
+
+    def _deliver(self, request_id, future, on_output, payload):
+        # A failing callback fails its own request, not the whole connection
+        try:
+            on_output(payload)
+        except Exception as e:
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+            settle(future, error=e)
+            with self.pending_lock:
+                drained = self._drained()
+            if drained:
+                self.close()
+
+    def _forget(self, request_id):
+        # Drop an abandoned request, waiting out an output being delivered for
+        # it, so frames the server still sends for it are ignored
+        with self.deliver_lock, self.pending_lock:
+            self.pending.pop(request_id, None)
+            drained = self._drained()
+        if drained:
+            self.close()
+
+    def _drained(self):
+        # Whether a retired connection has nothing left in flight; call with
+        # pending_lock held
+        return self.retiring and not self.closed and not self.pending
+
+    def retire(self):
+        # Stop using the connection without failing the requests on it: it is
+        # closed as soon as the last of them is done
+        with self.pending_lock:
+            self.retiring = True
+            drained = self._drained()
+        if drained:
+            self.close()
+
+    def _fail(self, error):
+        # Fail every outstanding request; the pool will open a fresh connection
+        with self.pending_lock:
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        for future, _ in pending.values():
+            settle(future, error=error)
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._fail(ConnectionError("Connection closed by client"))
+
+class ConnectionPool:
+    # Keeps `size` connections per server open across tiles and images and
+    # hands them out round-robin, reconnecting any that have dropped
+    def __init__(self, size=1, timeout=10, codec="auto"):
+        self.size = size
+        self.timeout = timeout
+        self.codec = codec
+        self.connections = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def get(self, server):
+        with self.lock:
+            slots = self.connections.setdefault(server, [None] * self.size)
+            slot = next(self.counters.setdefault(server, itertools.cycle(range(self.size))))
+            conn = slots[slot]
+            if conn is not None and not conn.closed:
+                return conn
+
+        # Connect outside the lock so one unreachable server doesn't stall the rest
+        conn = Connection(server[0], server[1], self.timeout, self.codec)
+        with self.lock:
+            current = slots[slot]
+            if current is not None and not current.closed:
+                conn.close()
+                return current
+            slots[slot] = conn
+            return conn
+
+    def evict(self, server, conn):
+        # Take a connection that stopped answering out of the pool; the next
+        # request for the server opens a fresh one. Other requests already on
+        # it are left to finish or time out by themselves rather than failed
+        # along with it, and it is closed once they are done.
+        with self.lock:
+            slots = self.connections.get(server, [])
+            for slot, current in enumerate(slots):
+                if current is conn:
+                    slots[slot] = None
+        conn.retire()
+
+    def request(self, server, *buffers):
+        return self.get(server).request(*buffers)
+
+    def close(self):
+        with self.lock:
+            for slots in self.connections.values():
+                for conn in slots:
+                    if conn is not None:
+                        conn.close()
+            self.connections.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
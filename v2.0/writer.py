@@ -0,0 +1,94 @@
+import os
+import queue
+import threading
+import cv2
+import numpy as np
+
+# Encoding parameters per file format; `level` is only used by PNG
+FORMATS = {
+    "png": lambda level: [cv2.IMWRITE_PNG_COMPRESSION, level],
+    "tiff": lambda level: [],
+    "bmp": lambda level: [],
+    "npy": None,
+}
+
+class DiskWriter:
+    # Saves server artifacts on background threads so encoding and disk I/O
+    # stay off the response path. The queue is bounded; when it is full the
+    # "block" policy makes callers wait (backpressure on processing) and the
+    # "drop" policy skips the file and counts it instead.
+    def __init__(self, directory, format="png", level=1, enabled=True, max_queue=64, policy="block", threads=1):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown output format {format}")
+        if policy not in ("block", "drop"):
+            raise ValueError(f"Unknown backpressure policy {policy}")
+        self.directory = directory
+        self.format = format
+        self.params = FORMATS[format](level) if FORMATS[format] is not None else None
+        self.enabled = enabled
+        self.policy = policy
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.threads = []
+        if enabled:
+            os.makedirs(directory, exist_ok=True)
+            for _ in range(threads):
+                thread = threading.Thread(target=self._run, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def save(self, name, image):
+        # Queue `image` to be written as <directory>/<name>.<format>. The array
+        # must not be modified afterwards.
+        if not self.enabled:
+            return
+        if self.policy == "block":
+            self.queue.put((name, image))
+            return
+        try:
+            self.queue.put_nowait((name, image))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                name, image = item
+                path = os.path.join(self.directory, f"{name}.{self.format}")
+                if self.params is None:
+                    np.save(path, image)
+                    ok = True
+                else:
+                    ok = cv2.imwrite(path, image, self.params)
+                with self.lock:
+                    if ok:
+                        self.written += 1
+                    else:
+                        self.failed += 1
+                if not ok:
+                    print(f"Failed to save {path}")
+            except Exception as e:
+                with self.lock:
+                    self.failed += 1
+                print(f"Failed to save {item[0]}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        # Wait until everything queued so far is on disk
+        self.queue.join()
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        print(f"Disk writer: {self.written} written, {self.dropped} dropped, {self.failed} failed")